@@ -0,0 +1,143 @@
+"""End-to-end benchmark for ingest and scoring.
+
+Usage:
+    python bench_ingest.py [--scales 500,2000] [--players-per-game 0.1]
+        [--profile "bulk load"] [--output results.json] [--keep DIR]
+
+For every scale (a number of games), synthdata writes a sources directory
+and a fresh SQLite database is filled from it with
+refresh.refresh(..., fetch=False). Then every CsdcWeek scorecard and
+web.standingspage() are timed against that database. Results are written
+as JSON, to stdout unless --output is given, so runs can be compared.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import sqlalchemy
+
+import csdc
+import model
+import orm
+import refresh
+import synthdata
+import web
+
+
+def _timed(f, *args, **kwargs) -> float:
+    t_i = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - t_i
+
+
+def _scorecard(wk: csdc.CsdcWeek) -> int:
+    with orm.get_session() as s:
+        return len(wk.scorecard().with_session(s).all())
+
+
+def run_scale(workdir: str, games: int, players: int, seed: int=1,
+        profile: str="default") -> dict:
+    """Generate, ingest and score one data set, returning its timings."""
+    src = os.path.join(workdir, "sources")
+    db = os.path.join(workdir, "bench.db")
+    t_i = time.perf_counter()
+    lines = synthdata.generate(src, players, games, seed)
+    generate_s = time.perf_counter() - t_i
+
+    orm.initialize("sqlite:///" + db, orm.profile_pragmas(profile))
+    model.clear_caches()
+    model.setup_database()
+    del csdc.weeks[:]
+    csdc.initialize_weeks()
+
+    t_i = time.perf_counter()
+    stats = refresh.refresh(synthdata.SOURCES_FILE, src, fetch=False)
+    refresh_s = time.perf_counter() - t_i
+    # Nothing new: the cost of a refresh between updates
+    noop_refresh_s = _timed(refresh.refresh, synthdata.SOURCES_FILE, src,
+            fetch=False)
+
+    scorecards = {}
+    for wk in csdc.weeks:
+        t_i = time.perf_counter()
+        rows = _scorecard(wk)
+        scorecards[wk.number] = {"seconds": time.perf_counter() - t_i,
+                "rows": rows}
+    standings_s = _timed(web.standingspage)
+
+    with orm.get_session() as s:
+        milestones = s.query(orm.Milestone).count()
+        # Under WAL most pages are still in bench.db-wal until a checkpoint.
+        s.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return {
+        "games": games,
+        "players": players,
+        "profile": profile,
+        "lines": lines,
+        "milestones": milestones,
+        "db_bytes": os.path.getsize(db),
+        "generate_s": generate_s,
+        "refresh_s": refresh_s,
+        "refresh_lines_per_s": lines / refresh_s if refresh_s else None,
+        "noop_refresh_s": noop_refresh_s,
+        "ingest": stats.as_dict()["total"],
+        "scorecard": scorecards,
+        "scorecard_total_s": sum(sc["seconds"] for sc in scorecards.values()),
+        "standings_s": standings_s,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+            description="Benchmark refresh, scorecards and the standings page.")
+    parser.add_argument("--scales", default="500,2000",
+            help="comma separated numbers of games")
+    parser.add_argument("--players-per-game", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--profile", default="default",
+            help="database pragma profile, see orm.PROFILES")
+    parser.add_argument("--output", help="write the JSON results here")
+    parser.add_argument("--keep", help="generate under this directory and keep it")
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "runs": [],
+    }
+    for games in (int(x) for x in args.scales.split(",")):
+        players = max(1, int(games * args.players_per_game))
+        if args.keep:
+            workdir = os.path.join(args.keep, str(games))
+            shutil.rmtree(workdir, ignore_errors=True)
+            os.makedirs(workdir)
+        else:
+            workdir = tempfile.mkdtemp(prefix="bench_ingest")
+        try:
+            run = run_scale(workdir, games, players, args.seed, args.profile)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        logging.warning("{} games: refresh {:.2f}s, scorecards {:.2f}s, standings {:.2f}s".format(
+            games, run["refresh_s"], run["scorecard_total_s"], run["standings_s"]))
+        results["runs"].append(run)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,82 @@
+"""Micro-benchmark for modelutils.logline_to_dict.
+
+Usage:
+    python bench_logline.py sources/cko/crawl-meta-bcrawl-milestones [repeats]
+
+Parses every 'v=1.' line of a recorded logfile with the current parser and
+with the old field-by-field replace/split parser, checks they agree and prints lines/sec.
+"""
+
+import sys
+import time
+import logging
+
+import constants as const
+import modelutils
+
+
+def _split_logline_to_dict(logline: str) -> dict:
+    """The replace/split parser logline_to_dict used to be."""
+    data = {}
+    logline = logline.replace("::", "@@")
+    pairs = logline.split(':')
+    for p in pairs:
+        p = p.replace("@@",":")
+        keyval = p.split('=')
+        try:
+            data[keyval[0]] = keyval[1]
+        except IndexError as e:
+            pass
+    if "god" not in data:
+        data["god"] = "GOD_NO_GOD"
+
+    data["god"] = const.GOD_NAME_FIXUPS.get(data["god"],data["god"])
+    if "end" in data:
+        data["time"] = data["end"]
+        data["ktyp"] = const.KTYP_FIXUPS.get(data["ktyp"], data["ktyp"])
+        data["type"] = "death.final"
+        data["milestone"] = data["tmsg"]
+
+    data["runes"] = data.get("urune", 0)
+    return data
+
+
+def _time(parse, lines, repeats):
+    best = None
+    for _ in range(repeats):
+        t_i = time.perf_counter()
+        for line in lines:
+            parse(line)
+        t = time.perf_counter() - t_i
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main(path: str, repeats: int = 5) -> None:
+    with open(path, 'rb') as f:
+        lines = [l.decode() for l in f if l.startswith(b"v=1.")]
+    if not lines:
+        sys.exit("no v=1. lines in {}".format(path))
+
+    mismatches = sum(1 for l in lines
+            if modelutils.logline_to_dict(l) != _split_logline_to_dict(l))
+    if mismatches:
+        print("WARNING: {} lines parse differently".format(mismatches))
+
+    results = [
+        ("old split", _split_logline_to_dict),
+        ("current", modelutils.logline_to_dict),
+        ("event fields",
+            lambda l: modelutils.logline_to_dict(l, modelutils.EVENT_FIELDS)),
+    ]
+    print("{} lines, best of {}".format(len(lines), repeats))
+    for name, parse in results:
+        t = _time(parse, lines, repeats)
+        print("{:>12}: {:10.0f} lines/sec".format(name, len(lines) / t))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1], *[int(x) for x in sys.argv[2:3]])
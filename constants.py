@@ -271,6 +271,7 @@ KTYP_FIXUPS = {
 
 VERBS = (
     "begin",
+    "xl",
     "br.enter",
     "br.end",
     "br.exit",
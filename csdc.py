@@ -208,53 +208,52 @@ class CsdcWeek:
 					sc.c.qaz + sc.c.chei + sc.c.lucy + sc.c.jiyva).label("total")
 			).group_by(sc.c.player_id).order_by(desc("total"),Game.start)
 
+# The tournament weeks, see CsdcWeek
+WEEKS = (
+	dict(number = "1",
+		species = "Sk",
+		background = "AK",
+		gods = (),
+		start = datetime.datetime(2019,12,20),
+		end = datetime.datetime(2019,12,29)),
+	dict(number = "2",
+		species = "On",
+		background = "VM",
+		gods = (),
+		start = datetime.datetime(2019,12,23),
+		end = datetime.datetime(2020,1,1)),
+	dict(number = "3",
+		species = "VS",
+		background = "Rg",
+		gods = (),
+		start = datetime.datetime(2019,12,26),
+		end = datetime.datetime(2020,1,4)),
+	dict(number = "4",
+		species = "Dj",
+		background = "Cj",
+		gods = (),
+		start = datetime.datetime(2019,12,29),
+		end = datetime.datetime(2020,1,7)),
+	dict(number = "5",
+		species = "SD",
+		background = "SA",
+		gods = (),
+		start = datetime.datetime(2020,1,1),
+		end = datetime.datetime(2020,1,10)),
+	dict(number = "6",
+		species = "Hu",
+		background = "Wz",
+		gods = (),
+		start = datetime.datetime(2020,1,4),
+		end = datetime.datetime(2020,1,13)),
+)
+
 weeks = []
 
 def initialize_weeks():
-	with get_session() as s:
-		
-		weeks.append(CsdcWeek(
-			number = "1",
-			species = "Sk",
-			background = "AK",
-			gods = (),
-			start = datetime.datetime(2019,12,20),
-			end = datetime.datetime(2019,12,29)))
-		weeks.append(CsdcWeek(
-			number = "2",
-			species = "On",
-			background = "VM",
-			gods = (),
-			start = datetime.datetime(2019,12,23),
-			end = datetime.datetime(2020,1,1)))
-		weeks.append(CsdcWeek(
-			number = "3",
-			species = "VS",
-			background = "Rg",
-			gods = (),
-			start = datetime.datetime(2019,12,26),
-			end = datetime.datetime(2020,1,4)))
-		weeks.append(CsdcWeek(
-			number = "4",
-			species = "Dj",
-			background = "Cj",
-			gods = (),
-			start = datetime.datetime(2019,12,29),
-			end = datetime.datetime(2020,1,7)))
-		weeks.append(CsdcWeek(
-			number = "5",
-			species = "SD",
-			background = "SA",
-			gods = (),
-			start = datetime.datetime(2020,1,1),
-			end = datetime.datetime(2020,1,10)))
-		weeks.append(CsdcWeek(
-			number = "6",
-			species = "Hu",
-			background = "Wz",
-			gods = (),
-			start = datetime.datetime(2020,1,4),
-			end = datetime.datetime(2020,1,13)))
+	with get_session():
+		for wk in WEEKS:
+			weeks.append(CsdcWeek(**wk))
 
 
 def overview():
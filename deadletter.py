@@ -0,0 +1,165 @@
+"""Dead-letter files for loglines that could not be imported.
+
+Bad lines are kept in memory and appended in bulk to a JSON lines file
+next to the source's logfiles (sources_dir/<source>/dead-letters.jsonl),
+one record per line:
+
+    {"file": ..., "offset": ..., "error": "KeyError", "message": ...,
+     "line": ...}
+
+offset is where the line starts in file. Records are appended with a
+single write, so a worker process and the writer can share a file.
+Logging is rate-limited: the first bad line of each source is logged,
+after that at most one summary every LOG_INTERVAL seconds, and a total
+when the sink is closed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, List
+
+FILENAME = "dead-letters.jsonl"
+# Seconds between summary logs for the same source
+LOG_INTERVAL = 60.0
+
+
+def path(file: str) -> str:
+    """The dead-letter file for a source file."""
+    return os.path.join(os.path.dirname(file), FILENAME)
+
+
+def read_line(file: str, offset: int) -> bytes:
+    """Read the line starting at offset from file."""
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        return f.readline()
+
+
+def record(file: str, offset: int, line: str, error: BaseException) -> dict:
+    """A dead-letter record. line is kept whole, with its newline."""
+    return {
+        "file": file,
+        "offset": offset,
+        "error": type(error).__name__,
+        "message": str(error),
+        "line": line,
+    }
+
+
+class DeadLetters:
+    """A buffered, rate-limited sink for bad lines.
+
+    Records are kept until flush(), callers flush before committing the
+    offset past a bad line so none are lost. One sink can be shared by
+    threads, e.g. the parse and write stages of a refresh: a flush writes
+    every record added before it, whichever thread added them. Usable as a
+    context manager, which closes it.
+    """
+
+    def __init__(self) -> None:
+        self.pending = {}  # type: dict
+        self.counts = {}  # type: dict
+        self._logged = {}  # type: dict
+        self._unlogged = {}  # type: dict
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Sent back from worker processes, without the lock
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, file: str, offset: int, line: bytes, error: BaseException) -> None:
+        rec = record(file, offset, line.decode(errors="replace"), error)
+        dest = path(file)
+        with self._lock:
+            self.pending.setdefault(dest, []).append(rec)
+            self.counts[dest] = self.counts.get(dest, 0) + 1
+            self._log(dest, rec)
+
+    def _log(self, dest: str, rec: dict) -> None:
+        now = time.monotonic()
+        self._unlogged[dest] = self._unlogged.get(dest, 0) + 1
+        if dest not in self._logged:
+            logging.warning("Bad line at {file}:{offset} ({error}: {message}), "
+                "see {dest}".format(dest=dest, **rec))
+        elif now - self._logged[dest] >= LOG_INTERVAL:
+            logging.warning("{} more bad lines written to {}".format(
+                self._unlogged[dest], dest))
+        else:
+            return
+        self._logged[dest] = now
+        self._unlogged[dest] = 0
+
+    def flush(self) -> None:
+        """Append the pending records to their files.
+
+        The lock is held while writing, so a flush that finds nothing
+        pending doesn't return before another thread's flush has written
+        the records it took.
+        """
+        with self._lock:
+            for dest, records in self.pending.items():
+                data = "".join(json.dumps(r) + "\n" for r in records).encode()
+                with open(dest, 'ab', buffering=0) as f:
+                    f.write(data)
+            self.pending = {}
+
+    def merge(self, other: 'DeadLetters') -> None:
+        """Add the totals of another, flushed, sink, e.g. a worker's."""
+        with self._lock:
+            for dest, count in other.counts.items():
+                self.counts[dest] = self.counts.get(dest, 0) + count
+
+    def close(self) -> None:
+        self.flush()
+        for dest, count in self.counts.items():
+            logging.warning("{} bad lines written to {}".format(count, dest))
+
+    def __enter__(self) -> 'DeadLetters':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read(dest: str) -> List[dict]:
+    """Read the records of a dead-letter file, in the order they were added.
+
+    A line may have been recorded more than once if a refresh was
+    interrupted, only its first record is returned.
+    """
+    records = {}  # type: dict
+    with open(dest) as f:
+        for l in f:
+            if l.strip():
+                r = json.loads(l)
+                records.setdefault((r["file"], r["offset"]), r)
+    return list(records.values())
+
+
+def rewrite(dest: str, records: List[dict]) -> None:
+    """Replace a dead-letter file's records, removing it if there are none."""
+    if not records:
+        if os.path.exists(dest):
+            os.remove(dest)
+        return
+    tmp = dest + ".tmp"
+    with open(tmp, 'w') as f:
+        f.writelines(json.dumps(r) + "\n" for r in records)
+    os.replace(tmp, dest)
+
+
+def files(sources_dir: str) -> Iterator[str]:
+    """The dead-letter files under a sources directory."""
+    for src in sorted(os.scandir(sources_dir), key=lambda e: e.name):
+        dest = os.path.join(src.path, FILENAME)
+        if src.is_dir() and os.path.isfile(dest):
+            yield dest
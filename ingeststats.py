@@ -0,0 +1,124 @@
+"""Counters and timers for a refresh, kept per source file.
+
+Counters:
+    bytes_read: bytes of the file scanned
+    lines_seen: complete lines scanned
+    lines_parsed: event lines parsed into events
+    parse_errors: event lines that could not be parsed
+    events: events handed to the database (crash lines are dropped)
+    events_rejected: events that could not be normalised into rows
+    games_inserted, milestones_inserted: rows actually inserted, lines
+        that were already imported don't count
+    games_opened, games_closed: begin and end events of open games
+    commits: batches committed
+
+Timers, in seconds:
+    read_s: scanning the file for lines
+    parse_s: parsing lines into events
+    lookup_s: normalising events into rows, including id lookups
+    flush_s: writing the rows
+    commit_s: committing them with the new offset
+
+downloads holds the download health of every source after a refresh that
+fetched, see sources.SourceHealth.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Iterator
+
+COUNTERS = ("bytes_read", "lines_seen", "lines_parsed", "parse_errors",
+        "events", "events_rejected", "games_inserted", "milestones_inserted", "games_opened",
+        "games_closed", "commits")
+TIMERS = ("read_s", "parse_s", "lookup_s", "flush_s", "commit_s")
+
+
+def source_name(file: str) -> str:
+    """Files are stored as sources_dir/<source name>/<file name>."""
+    return os.path.basename(os.path.dirname(file))
+
+
+class IngestStats:
+    """Counters and timers of one refresh, by file.
+
+    Each file's counters are a collections.Counter, see the module
+    docstring for their names. Instances can be pickled, so worker
+    processes can send theirs back to be merged.
+    """
+
+    def __init__(self) -> None:
+        self.files = {}  # type: dict
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.downloads = {}  # type: dict
+
+    def file(self, file: str) -> collections.Counter:
+        if file not in self.files:
+            self.files[file] = collections.Counter()
+        return self.files[file]
+
+    def add(self, file: str, **counts: float) -> None:
+        self.file(file).update(counts)
+
+    @contextlib.contextmanager
+    def timer(self, file: str, name: str) -> Iterator[None]:
+        t_i = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.file(file)[name] += time.perf_counter() - t_i
+
+    def merge(self, other: 'IngestStats') -> None:
+        for file, counts in other.files.items():
+            self.file(file).update(counts)
+
+    def sources(self) -> dict:
+        """The counters summed by source."""
+        totals = {}  # type: dict
+        for file, counts in self.files.items():
+            totals.setdefault(source_name(file), collections.Counter()).update(counts)
+        return totals
+
+    def total(self) -> collections.Counter:
+        total = collections.Counter()  # type: collections.Counter
+        for counts in self.files.values():
+            total.update(counts)
+        return total
+
+    def changed(self) -> bool:
+        """Whether any rows were written."""
+        total = self.total()
+        return bool(total["games_inserted"] or total["milestones_inserted"]
+            or total["games_closed"])
+
+    def as_dict(self) -> dict:
+        def full(counts):
+            return {k: counts.get(k, 0) for k in COUNTERS + TIMERS}
+        return {
+            "started": self.started,
+            "elapsed_s": self.elapsed,
+            "total": full(self.total()),
+            "sources": {name: full(c) for name, c in sorted(self.sources().items())},
+            "files": {file: full(c) for file, c in sorted(self.files.items())},
+            "downloads": self.downloads,
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+            f.write("\n")
+
+    def log_summary(self, level: int=logging.INFO) -> None:
+        for name, c in sorted(self.sources().items()) + [("total", self.total())]:
+            logging.log(level, "{}: {} lines ({} bytes), {} events, "
+                "{} bad lines, {} games and {} milestones inserted, {} commits; "
+                "read {:.2f}s, parse {:.2f}s, lookup {:.2f}s, flush {:.2f}s, "
+                "commit {:.2f}s".format(name, c["lines_seen"], c["bytes_read"],
+                    c["events"], c["parse_errors"] + c["events_rejected"],
+                    c["games_inserted"], c["milestones_inserted"],
+                    c["commits"], c["read_s"], c["parse_s"], c["lookup_s"],
+                    c["flush_s"], c["commit_s"]))
@@ -1,13 +1,18 @@
 import os
+import sys
+import argparse
 import logging
 import yaml
 import refresh
+import sources
+import pipeline
 import model
 import orm
 import csdc
 import web
 import time
 import datetime
+import signal
 
 SOURCES_DIR = './sources'
 CONFIG_FILE = 'config.yml'
@@ -22,33 +27,108 @@ if 'logging level' in CONFIG and hasattr(logging, CONFIG['logging level']):
 
 logging.basicConfig(level=logging_level)
 
-if __name__=='__main__':
-	orm.initialize(CONFIG['db uri'])
-	model.setup_database()
-	refresh.refresh(CONFIG['sources file'], SOURCES_DIR)
-	csdc.initialize_weeks()
+def pages_current(www_dir, now):
+	"""Whether the pages were written after the last week started."""
+	standings = os.path.join(www_dir, "standings.html")
+	if not os.path.isfile(standings):
+		return False
+	written = datetime.datetime.utcfromtimestamp(os.path.getmtime(standings))
+	return all(wk.start <= written for wk in csdc.weeks if wk.start <= now)
+
+def update(keep, connections=None):
+	"""Import new lines, returning the refresh's IngestStats."""
+	return refresh.refresh(CONFIG['sources file'], SOURCES_DIR,
+		batch_size=CONFIG.get('ingest batch size', refresh.BATCH_SIZE),
+		processes=CONFIG.get('ingest processes', 1),
+		read_batch_size=CONFIG.get('ingest read batch size', refresh.READ_BATCH_SIZE),
+		queue_size=CONFIG.get('ingest queue size', pipeline.QUEUE_SIZE),
+		keep=keep,
+		stats_file=CONFIG.get('ingest stats file'),
+		stream=CONFIG.get('ingest stream downloads', False),
+		connections=connections)
+
+def render(stats):
+	"""Rebuild the pages, unless nothing changed since they were written."""
 	t_i = time.time()
 	now = datetime.datetime.utcnow()
+	if not stats.changed() and pages_current(CONFIG['www dir'], now):
+		logging.info("No new games or milestones, pages are current.")
+		return
 	oldmask = os.umask(18)
-	for wk in csdc.weeks:
-		if wk.start > now:
-			continue
-		scorepage = os.path.join(CONFIG['www dir'],"{}.html".format(wk.number))
-
-		with open(scorepage, 'w') as f:
-			f.write(web.scorepage(wk))
-	logging.info("Rebuilt score pages in {} seconds.".format(time.time() -
-		t_i))
-
-	standings = os.path.join(CONFIG['www dir'],"standings.html")
-	with open(standings, 'w') as f:
-		f.write(web.standingspage())
-
-	index = os.path.join(CONFIG['www dir'],"index.html")
-	with open(index, 'w') as f:
-		f.write(web.overviewpage())
-
-	rules = os.path.join(CONFIG['www dir'],"rules.html")
-	with open(rules, 'w') as f:
-		f.write(web.rulespage())
-	os.umask(oldmask)
+	try:
+		with orm.get_session():  # one session for every page
+			for wk in csdc.weeks:
+				if wk.start > now:
+					continue
+				scorepage = os.path.join(CONFIG['www dir'],"{}.html".format(wk.number))
+
+				with open(scorepage, 'w') as f:
+					f.write(web.scorepage(wk))
+			logging.info("Rebuilt score pages in {} seconds.".format(time.time() -
+				t_i))
+
+			standings = os.path.join(CONFIG['www dir'],"standings.html")
+			with open(standings, 'w') as f:
+				f.write(web.standingspage())
+
+			index = os.path.join(CONFIG['www dir'],"index.html")
+			with open(index, 'w') as f:
+				f.write(web.overviewpage())
+
+			rules = os.path.join(CONFIG['www dir'],"rules.html")
+			with open(rules, 'w') as f:
+				f.write(web.rulespage())
+	finally:
+		os.umask(oldmask)
+
+def watch(keep, interval):
+	"""Update and render every interval seconds until interrupted.
+
+	The process stays up, so the lookup tables, open games and weeks loaded
+	by the first cycle are reused, as are the connections to the servers.
+	A failed cycle is logged and retried at the next tick.
+	"""
+	connections = sources.Connections()
+	try:
+		while True:
+			t_i = time.time()
+			try:
+				render(update(keep, connections))
+			except (Exception, model.DBError, model.DBIntegrityError):
+				logging.exception("Update failed, retrying in {} seconds.".format(interval))
+			time.sleep(max(0, interval - (time.time() - t_i)))
+	except KeyboardInterrupt:
+		logging.info("Stopped watching.")
+	finally:
+		connections.close()
+
+if __name__=='__main__':
+	parser = argparse.ArgumentParser(description='Update the CSDC database and score pages.')
+	parser.add_argument('--verify-checkpoints', action='store_true',
+		help='check the saved logfile offsets against the files and the database, then exit')
+	parser.add_argument('--replay-dead-letters', action='store_true',
+		help='import the lines in the dead-letter files again, then exit')
+	parser.add_argument('--watch', action='store_true',
+		help="keep running, updating every 'watch interval' seconds")
+	parser.add_argument('--bulk-load', action='store_true',
+		help="use the 'bulk load' database profile, e.g. for a backfill")
+	args = parser.parse_args()
+
+	profile = 'bulk load' if args.bulk_load else CONFIG.get('db profile', 'default')
+	orm.initialize(CONFIG['db uri'],
+		orm.profile_pragmas(profile, CONFIG.get('db pragmas')))
+	model.setup_database()
+	if args.replay_dead_letters:
+		sys.exit(0 if refresh.replay_dead_letters(SOURCES_DIR) == 0 else 1)
+	csdc.initialize_weeks()
+	keep = None
+	if CONFIG.get('ingest tournament games only', False):
+		keep = refresh.TournamentFilter.from_weeks(csdc.weeks)
+	if args.verify_checkpoints:
+		# With the filter the files were imported with
+		sys.exit(0 if refresh.verify_checkpoints(keep) else 1)
+	if args.watch:
+		signal.signal(signal.SIGTERM, signal.default_int_handler)
+		watch(keep, CONFIG.get('watch interval', 60))
+	else:
+		render(update(keep))
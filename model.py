@@ -1,14 +1,16 @@
 """Defines the database models for this module."""
 
+import collections
 import functools
 import datetime
-from typing import Optional, Tuple, Callable, Sequence
+import threading
+from typing import Optional, Tuple, Callable, Sequence, Iterable, Iterator
 
 import os
 import sqlalchemy
 import sqlalchemy.orm
 import sqlalchemy.ext.declarative  # for typing
-from sqlalchemy import func, asc, desc
+from sqlalchemy import asc, desc
 
 import logging
 import modelutils
@@ -69,42 +71,183 @@ def _reraise_dberror(function: Callable) -> Callable:
     return f
 
 
-@functools.lru_cache(maxsize=16)
+class _Dimension:
+    """One lookup table, held in memory as {key: row}.
+
+    Rows are loaded on first use and detached from the session that loaded
+    them, so they can be shared by every session in the process. Missing
+    keys are inserted through the caller's session and added to the map.
+    """
+
+    def __init__(self, cls: sqlalchemy.ext.declarative.api.DeclarativeMeta,
+            key: Callable, new: Callable) -> None:
+        self.cls = cls
+        self.key = key
+        self.new = new
+        self.rows = None  # type: Optional[dict]
+
+    def load(self, s: sqlalchemy.orm.session.Session) -> None:
+        rows = s.query(self.cls).all()
+        for row in rows:
+            s.expunge(row)
+        self.rows = {self.key(row): row for row in rows}
+
+    def get(self, s: sqlalchemy.orm.session.Session, key):  # type: ignore
+        with _dimensions_lock:
+            if self.rows is None:
+                self.load(s)
+            row = self.rows.get(key)  # type: ignore
+            if row is None:
+                row = self.new(key)
+                s.add(row)
+                s.flush()
+                s.expunge(row)
+                self.rows[key] = row  # type: ignore
+                _cached_uncommitted(s)
+            return row
+
+
+def _warn_new(what: str, make: Callable, update: bool=True) -> Callable:
+    """Wrap a lookup row constructor to warn that constants.py is missing it."""
+
+    def new(key):  # type: ignore
+        logging.warning("Found new %s %s, please add me to constants.py%s"
+                % (what, key, " and update the database." if update else ""))
+        return make(key)
+
+    return new
+
+
+def _new_version(v: str) -> Version:
+    logging.info("Adding version '%s'" % v)
+    return Version(v=v)
+
+
+_dimensions_lock = threading.RLock()
+_servers = _Dimension(Server, lambda r: r.name, lambda k: Server(name=k))
+_versions = _Dimension(Version, lambda r: r.v, _new_version)
+_species = _Dimension(Species, lambda r: r.short,
+        _warn_new("species", lambda k: Species(short=k, name=k)))
+_backgrounds = _Dimension(Background, lambda r: r.short,
+        _warn_new("background", lambda k: Background(short=k, name=k)))
+_gods = _Dimension(God, lambda r: r.name,
+        _warn_new("god", lambda k: God(name=k)))
+_ktyps = _Dimension(Ktyp, lambda r: r.name,
+        _warn_new("ktyp", lambda k: Ktyp(name=k), update=False))
+_verbs = _Dimension(Verb, lambda r: r.name,
+        _warn_new("verb", lambda k: Verb(name=k), update=False))
+_skills = _Dimension(Skill, lambda r: r.name,
+        _warn_new("skill", lambda k: Skill(name=k), update=False))
+_branches = _Dimension(Branch, lambda r: r.short,
+        _warn_new("branch", lambda k: Branch(short=k, name=k, multilevel=True)))
+_places = _Dimension(Place, lambda r: (r.branch_id, r.level),
+        lambda k: Place(branch_id=k[0], level=k[1]))
+
+_DIMENSIONS = (_servers, _versions, _species, _backgrounds, _gods, _ktyps,
+        _verbs, _skills, _branches, _places)
+
+
+def load_dimensions(s: sqlalchemy.orm.session.Session) -> None:
+    """Load every lookup table into memory."""
+    with _dimensions_lock:
+        for dim in _DIMENSIONS:
+            dim.load(s)
+
+
 def get_server(s: sqlalchemy.orm.session.Session, name: str) -> Server:
     """Get a server, creating it if needed."""
-    server = s.query(Server).filter(Server.name == name).first()
-    if server:
-        return server
-    else:
-        server = Server(name=name)
-        s.add(server)
-        s.commit()
-        return server
+    return _servers.get(s, name)
+
+
+# SQLite allows at most 999 bound parameters per statement
+_IN_CHUNK = 500
+
+# {(name_key, server_id): (account_id, player_id)} of every account resolved so far
+_accounts = {}  # type: dict
+
+
+def _chunks(seq: Sequence, n: int=_IN_CHUNK) -> Iterator[Sequence]:
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def _player_ids(s: sqlalchemy.orm.session.Session, keys: Sequence[str]) -> dict:
+    """Get {name_key: id} of the players that exist out of keys."""
+    ids = {}
+    for chunk in _chunks(keys):
+        ids.update(s.query(Player.name_key, Player.id).filter(
+            Player.name_key.in_(chunk)))
+    return ids
+
+
+def _account_ids(s: sqlalchemy.orm.session.Session, keys: Sequence[Tuple[str, int]]) -> dict:
+    """Get {(name_key, server_id): (id, player_id)} of the accounts that exist out of keys."""
+    wanted = set(keys)
+    ids = {}
+    for chunk in _chunks(sorted({k for k, _ in keys})):
+        for key, server_id, acc_id, player_id in s.query(Account.name_key,
+                Account.server_id, Account.id, Account.player_id).filter(
+                Account.name_key.in_(chunk)):
+            if (key, server_id) in wanted:
+                ids[(key, server_id)] = (acc_id, player_id)
+    return ids
+
+
+@_reraise_dberror
+def resolve_accounts(
+    s: sqlalchemy.orm.session.Session, accounts: Iterable[Tuple[str, int]]
+) -> dict:
+    """Get account and player ids, creating any that are missing.
+
+    Unknown accounts are looked up with one query per table and created
+    with one bulk insert per table, so a batch of events costs the same
+    few statements however many new players it brings.
+
+    Note that player names are not case sensitive, so names are stored with
+    their canonical capitalisation (the first one seen) but we always compare
+    the lowercase name_key.
+
+    Parameters:
+        accounts: (name, server id) pairs
+
+    Returns:
+        {(name_key, server_id): (account_id, player_id)}
+    """
+    names = {}  # type: dict
+    for name, server_id in accounts:
+        names.setdefault((name.lower(), server_id), name)
+    missing = [k for k in names if k not in _accounts]
+    if not missing:
+        return _accounts
+
+    found = _account_ids(s, missing)
+    new = [k for k in missing if k not in found]
+    if new:
+        player_names = {}  # type: dict
+        for k in new:
+            player_names.setdefault(k[0], names[k])
+        player_ids = _player_ids(s, list(player_names))
+        new_players = [{"name": player_names[k], "name_key": k}
+                for k in player_names if k not in player_ids]
+        if new_players:
+            s.bulk_insert_mappings(Player, new_players)
+            player_ids.update(_player_ids(s, [p["name_key"] for p in new_players]))
+        s.bulk_insert_mappings(Account, [{"name": names[k], "name_key": k[0],
+            "server_id": k[1], "player_id": player_ids[k[0]]} for k in new])
+        found.update(_account_ids(s, new))
+        _cached_uncommitted(s)
+    _accounts.update(found)
+    return _accounts
 
 
-@functools.lru_cache(maxsize=128)
 def get_account_id(s: sqlalchemy.orm.session.Session, name: str, server: Server) -> int:
     """Get an account id, creating the account if needed.
 
-    Note that player names are not case sensitive, so names are stored with
-    their canonical capitalisation but we always compare the lowercase version.
+    See resolve_accounts.
     """
-    player_id = get_player_id(s, name)
-    acc = (
-        s.query(Account.id)
-        .filter(func.lower(Account.name) == name.lower(), Account.server == server)
-        .one_or_none()
-    )
-    if acc:
-        return acc[0]
-    else:
-        acc = Account(name=name, server=server, player_id=player_id)
-        s.add(acc)
-        s.commit()
-        return acc.id
+    return resolve_accounts(s, [(name, server.id)])[(name.lower(), server.id)][0]
 
 
-@functools.lru_cache(maxsize=128)
 def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
     """Get a player's object, creating them if needed.
 
@@ -112,7 +255,7 @@ def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
     their canonical capitalisation but we always compare the lowercase version.
     """
     player = (
-        s.query(Player).filter(func.lower(Player.name) == name.lower()).one_or_none()
+        s.query(Player).filter(Player.name_key == name.lower()).one_or_none()
     )
     if player:
         return player
@@ -120,15 +263,14 @@ def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
         return _add_player(s, name)
 
 
-@functools.lru_cache(maxsize=128)
-def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> Player:
+def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> int:
     """Get a player's id, creating them if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
     player = (
-        s.query(Player.id).filter(func.lower(Player.name) == name.lower()).one_or_none()
+        s.query(Player.id).filter(Player.name_key == name.lower()).one_or_none()
     )
     if player:
         return player[0]
@@ -136,10 +278,45 @@ def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> Player:
         return _add_player(s, name).id
 
 
+def clear_caches() -> None:
+    """Forget every cached row.
+
+    Needed after a rollback, which may have discarded rows created by the
+    getters. Lookup tables are loaded again on next use. Done automatically
+    when a session that changed the caches ends without committing.
+    """
+    _accounts.clear()
+    _open_games.clear()
+    with _dimensions_lock:
+        for dim in _DIMENSIONS:
+            dim.rows = None
+
+
+# Set in a session's info once the caches hold rows or open games that only
+# its transaction has written
+_UNCOMMITTED = "model.cached_uncommitted"
+
+
+def _cached_uncommitted(s: sqlalchemy.orm.session.Session) -> None:
+    s.info[_UNCOMMITTED] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _after_commit(s: sqlalchemy.orm.session.Session) -> None:
+    s.info.pop(_UNCOMMITTED, None)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_transaction_end")
+def _after_transaction_end(s: sqlalchemy.orm.session.Session, transaction) -> None:
+    """Clear the caches if they hold rows of a transaction that wasn't committed."""
+    if transaction.parent is None and s.info.pop(_UNCOMMITTED, False):
+        clear_caches()
+
+
 def _add_player(s, name: str) -> Player:
-    player = Player(name=name) 
+    player = Player(name=name, name_key=name.lower())
     s.add(player)
-    s.commit()
+    s.flush()
     return player
 
 
@@ -209,165 +386,133 @@ def setup_skills(s: sqlalchemy.orm.session.Session) -> None:
     s.commit()
 
 
-@functools.lru_cache(maxsize=32)
 def get_version(s: sqlalchemy.orm.session.Session, v: str) -> Version:
     """Get a version, creating it if needed."""
-    version = s.query(Version).filter(Version.v == v).first()
-    if version:
-        return version
-    else:
-        logging.info("Adding version '%s'" % v)
-        version = Version(v=v)
-        s.add(version)
-        s.commit()
-        return version
+    return _versions.get(s, v)
 
 
-def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
-    """Load branch data into the database."""
-    new = []
-    for br in const.BRANCHES:
-        if not s.query(Branch).filter(Branch.short == br.short).first():
-            logging.info("Adding branch '%s'" % br.full)
-            new.append(
-                {
-                    "short": br.short,
-                    "name": br.full,
-                    "multilevel": br.multilevel,
-                }
-            )
-    s.bulk_insert_mappings(Branch, new)
-    s.commit()
-
-
-@functools.lru_cache(maxsize=256)
 def get_place(s: sqlalchemy.orm.session.Session, branch: Branch, lvl: int) -> Place:
     """Get a place, creating it if needed."""
-    place = s.query(Place).filter(Place.branch == branch, Place.level == lvl).first()
-    if place:
-        return place
-    else:
-        place = Place(branch=branch, level=lvl)
-        s.add(place)
-        s.commit()
-        return place
+    return _places.get(s, (branch.id, int(lvl)))
 
 
 @functools.lru_cache(maxsize=256)
+def _parse_place(spot: str) -> Tuple[str, int]:
+    """Split a crawl Place:Lev string into its branch and level."""
+    code = spot.replace("$", "0").split(":") + [1]; # default to lvl 1 if missing 
+    return code[0], int(code[1])
+
+
 def get_place_from_string(s: sqlalchemy.orm.session.Session, spot: str) -> Place:
     """Get a place in crawl Place:Lev string format"""
-    code = spot.replace("$", "0").split(":") + [1]; # default to lvl 1 if missing 
-    return get_place(s, get_branch(s, code[0]), int(code[1]));
+    br, lvl = _parse_place(spot)
+    return get_place(s, get_branch(s, br), lvl)
 
 
-@functools.lru_cache(maxsize=64)
 def get_species(s: sqlalchemy.orm.session.Session, sp: str) -> Species:
     """Get a species by short code, creating it if needed."""
-    species = s.query(Species).filter(Species.short == sp).first()
-    if species:
-        return species
-    else:
-        species = Species(short=sp, name=sp)
-        s.add(species)
-        s.commit()
-        logging.warning(
-            "Found new species %s, please add me to constants.py"
-            " and update the database." % sp
-        )
-        return species
+    return _species.get(s, sp)
 
 
-@functools.lru_cache(maxsize=64)
 def get_background(s: sqlalchemy.orm.session.Session, bg: str) -> Background:
     """Get a background by short code, creating it if needed."""
-    background = s.query(Background).filter(Background.short == bg).first()
-    if background:
-        return background
-    else:
-        background = Background(short=bg, name=bg)
-        s.add(background)
-        s.commit()
-        logging.warning(
-            "Found new background %s, please add me to constants.py"
-            " and update the database." % bg
-        )
-        return background
+    return _backgrounds.get(s, bg)
 
 
-@functools.lru_cache(maxsize=32)
 def get_god(s: sqlalchemy.orm.session.Session, name: str) -> God:
     """Get a god by name, creating it if needed."""
-    god = s.query(God).filter(God.name == name).first()
-    if god:
-        return god
-    else:
-        god = God(name=name)
-        s.add(god)
-        s.commit()
-        logging.warning(
-            "Found new god %s, please add me to constants.py"
-            " and update the database." % name
-        )
-        return god
+    return _gods.get(s, name)
 
 
-@functools.lru_cache(maxsize=64)
 def get_ktyp(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
     """Get a ktyp by name, creating it if needed."""
-    ktyp = s.query(Ktyp).filter(Ktyp.name == name).first()
-    if ktyp:
-        return ktyp
-    else:
-        ktyp = Ktyp(name=name)
-        s.add(ktyp)
-        s.commit()
-        logging.warning("Found new ktyp %s, please add me to constants.py" % name)
-        return ktyp
+    return _ktyps.get(s, name)
 
 
-@functools.lru_cache(maxsize=64)
-def get_verb(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
+def get_verb(s: sqlalchemy.orm.session.Session, name: str) -> Verb:
     """Get a verb/type by name, creating it if needed."""
-    verb = s.query(Verb).filter(Verb.name == name).first()
-    if verb:
-        return verb
-    else:
-        verb = Verb(name=name)
-        s.add(verb)
-        s.commit()
-        logging.warning("Found new verb %s, please add me to constants.py" % name)
-        return verb
+    return _verbs.get(s, name)
 
 
-@functools.lru_cache(maxsize=64)
 def get_branch(s: sqlalchemy.orm.session.Session, br: str) -> Branch:
     """Get a branch by short name, creating it if needed."""
-    branch = s.query(Branch).filter(Branch.short == br).first()
-    if branch:
-        return branch
-    else:
-        branch = Branch(short=br, name=br, multilevel=True)
-        s.add(branch)
-        s.commit()
-        logging.warning(
-            "Found new branch %s, please add me to constants.py"
-            " and update the database." % br
-        )
-        return branch
+    return _branches.get(s, br)
 
 
-@functools.lru_cache(maxsize=64)
-def get_skill(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
-    """Get a verb/type by name, creating it if needed."""
-    skill = s.query(Skill).filter(Skill.name == name).first()
-    if skill:
-        return skill
-    else:
-        skill = Skill(name=name)
-        s.add(skill)
-        s.commit()
-        logging.warning("Found new skill %s, please add me to constants.py" % name)
-        return skill
+def get_skill(s: sqlalchemy.orm.session.Session, name: str) -> Skill:
+    """Get a skill by name, creating it if needed."""
+    return _skills.get(s, name)
+
+
+def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
+    """Load branch data into the database."""
+    new = []
+    for br in const.BRANCHES:
+        if not s.query(Branch).filter(Branch.short == br.short).first():
+            logging.info("Adding branch '%s'" % br.full)
+            new.append(
+                {
+                    "short": br.short,
+                    "name": br.full,
+                    "multilevel": br.multilevel,
+                }
+            )
+    s.bulk_insert_mappings(Branch, new)
+    s.commit()
+
+
+class _OpenGames:
+    """The gids of every game that has begun but not ended.
+
+    Loaded from the games table on first use and kept current as begins and
+    ends are written, so a game end can be applied with a plain UPDATE by
+    gid, and ends of unknown or already ended games are noticed without a
+    query. The gids of ended games are kept too, so a begin that is imported
+    again doesn't reopen its game.
+    """
+
+    def __init__(self) -> None:
+        self.gids = None  # type: Optional[set]
+        self.known = None  # type: Optional[set]
+
+    def _load(self, s: sqlalchemy.orm.session.Session) -> set:
+        if self.gids is None:
+            self.gids, self.known = set(), set()
+            for gid, ended in s.query(Game.gid, Game.end != None):
+                self.known.add(gid)
+                if not ended:
+                    self.gids.add(gid)
+        return self.gids
+
+    def is_new(self, s: sqlalchemy.orm.session.Session, gid: str) -> bool:
+        """Whether a game has never begun, open or ended."""
+        self._load(s)
+        return gid not in self.known  # type: ignore
+
+    def begin(self, s: sqlalchemy.orm.session.Session, gid: str) -> None:
+        self._load(s).add(gid)
+        self.known.add(gid)  # type: ignore
+        _cached_uncommitted(s)
+
+    def is_open(self, s: sqlalchemy.orm.session.Session, gid: str) -> bool:
+        return gid in self._load(s)
+
+    def end(self, s: sqlalchemy.orm.session.Session, gid: str) -> bool:
+        """Mark a game as ended. Returns False if it wasn't open."""
+        gids = self._load(s)
+        if gid not in gids:
+            logging.debug("Game end for %s, which isn't an open game" % gid)
+            return False
+        gids.remove(gid)
+        _cached_uncommitted(s)
+        return True
+
+    def clear(self) -> None:
+        self.gids = None
+        self.known = None
+
+
+_open_games = _OpenGames()
 
 
 @_reraise_dberror
@@ -386,9 +531,36 @@ def add_event(s: sqlalchemy.orm.session.Session, data: dict) -> None:
         _new_game(s, data)
     elif data["type"] == "death.final":
         _end_game(s, data)
-    
+
+    s.execute(_insert_milestones_stmt, _milestone_row(s, data))
+
+
+@_reraise_dberror
+def _new_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
+    """Create a game row on game begin."""
+    if not _open_games.is_new(s, data["gid"]):
+        return
+    row = _game_row(s, data)
+    account = _game_account(s, data)
+    _set_game_account(row, account, resolve_accounts(s, [account]))
+    s.execute(_insert_games_stmt, row)
+    _open_games.begin(s, data["gid"])
+
+
+@_reraise_dberror
+def _end_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
+    """Apply a game end to its open game."""
+    if _open_games.end(s, data["gid"]):
+        end = _game_end_row(s, data)
+        end["b_gid"] = data["gid"]
+        s.flush()
+        s.execute(_end_games_stmt, end)
+
+
+def _milestone_row(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """Normalise a milestone event into a milestones row."""
     branch = get_branch(s, data["br"])
-    m = {
+    return {
         "gid"      : data["gid"],
         "xl"       : data["xl"],
         "place_id" : get_place(s, branch, data["lvl"]).id,
@@ -406,39 +578,155 @@ def add_event(s: sqlalchemy.orm.session.Session, data: dict) -> None:
         "msg"     : data["milestone"]
     }
 
-    s.add(Milestone(**m))
 
+def _game_account(s: sqlalchemy.orm.session.Session, data: dict) -> Tuple[str, int]:
+    """The (name, server id) of a game's account, see resolve_accounts."""
+    return data["name"], get_server(s, data["src_abbr"]).id
 
-@_reraise_dberror
-def _new_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
-    """Create a game row on game begin."""
 
-    branch = get_branch(s, data["br"])
-    server = get_server(s, data["src_abbr"])
-    g = {
+def _set_game_account(row: dict, account: Tuple[str, int], accounts: dict) -> None:
+    """Fill in a games row's account and player from resolve_accounts."""
+    name, server_id = account
+    row["account_id"], row["player_id"] = accounts[(name.lower(), server_id)]
+
+
+def _game_row(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """Normalise a game begin event into a games row, without its account.
+
+    See _game_account and _set_game_account. The columns set by
+    _game_end_row are included as None, so every row has the same keys.
+    """
+    return {
         "gid": data["gid"],
-        "account_id": get_account_id(s, data["name"], server),
-        "player_id": get_player_id(s, data["name"]),
         "species_id": get_species(s, data["char"][:2]).id,
         "background_id": get_background(s, data["char"][2:]).id,
         "version_id": get_version(s, data["v"]).id,
-        "start": modelutils.crawl_date_to_datetime(data["start"])
+        "start": modelutils.crawl_date_to_datetime(data["start"]),
+        "end": None,
+        "ktyp_id": None,
+        "score": None,
+        "dam": None,
+        "tdam": None,
+        "sdam": None,
     }
 
-    s.add(Game(**g))
 
+def _game_end_row(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """Normalise a game end event into the columns it updates."""
+    dam = data.get("dam", 0)
+    return {
+        "end": modelutils.crawl_date_to_datetime(data["end"]),
+        "ktyp_id": get_ktyp(s, data["ktyp"]).id,
+        "score": data["sc"],
+        "dam": dam,
+        "tdam": data.get("tdam", dam),
+        "sdam": data.get("sdam", dam),
+    }
+
+
+_end_games_stmt = (
+    Game.__table__.update()
+    .where(Game.__table__.c.gid == sqlalchemy.bindparam("b_gid"))
+)
+
+
+def _insert_ignore(cls: sqlalchemy.ext.declarative.api.DeclarativeMeta) -> sqlalchemy.sql.expression.Insert:
+    """An INSERT that skips rows whose primary or unique key already exists."""
+    return (
+        cls.__table__.insert()
+        .prefix_with("OR IGNORE", dialect="sqlite")
+        .prefix_with("IGNORE", dialect="mysql")
+    )
+
+
+# Games are keyed by gid, milestones by ix_milestones_natural_key, so
+# importing the same lines again is a no-op
+_insert_games_stmt = _insert_ignore(Game)
+_insert_milestones_stmt = _insert_ignore(Milestone)
+
+
+class EventBatch:
+    """A batch of normalised milestone events waiting to be written.
+
+    Rows are kept as plain dicts and written with conflict-ignoring bulk
+    inserts and a single executemany UPDATE for game ends, which avoids the
+    ORM unit-of-work cost of one object per logline. Rows that are already
+    in the database are skipped.
+
+    counts holds the games_opened, games_closed, games_inserted and
+    milestones_inserted so far, see ingeststats.
+
+    XXX: flush() DOES NOT COMMIT YOU MUST COMMIT
+    """
+
+    def __init__(self, s: sqlalchemy.orm.session.Session) -> None:
+        self.s = s
+        self.counts = collections.Counter()  # type: collections.Counter
+        self.games = {}  # type: dict
+        self.accounts = {}  # type: dict
+        self.ends = {}  # type: dict
+        self.milestones = []  # type: list
+
+    def __len__(self) -> int:
+        return len(self.milestones)
+
+    @_reraise_dberror
+    def add_event(self, data: dict) -> None:
+        """Normalise a milestone event and queue its rows.
+
+        Every row is built before anything is queued, so an event that
+        can't be normalised (DBError from the original error) leaves the
+        batch as it was.
+        """
+        s = self.s
+        gid = data["gid"] = "%s:%s:%s" % (data["name"], data["src_abbr"], data["start"])
+        milestone = _milestone_row(s, data)
+
+        if data["type"] == "begin" and _open_games.is_new(s, gid):
+            game = _game_row(s, data)
+            self.accounts[gid] = _game_account(s, data)
+            self.games[gid] = game
+            _open_games.begin(s, gid)
+            self.counts["games_opened"] += 1
+        elif data["type"] == "death.final" and _open_games.is_open(s, gid):
+            end = _game_end_row(s, data)
+            _open_games.end(s, gid)
+            self.counts["games_closed"] += 1
+            if gid in self.games:
+                # Began and ended in this batch, no need for an UPDATE
+                self.games[gid].update(end)
+            else:
+                end["b_gid"] = gid
+                self.ends[gid] = end
+        elif data["type"] == "death.final":
+            logging.debug("Game end for %s, which isn't an open game" % gid)
+
+        self.milestones.append(milestone)
+
+    @_reraise_dberror
+    def flush(self) -> None:
+        """Write out the queued rows.
+
+        Games are inserted before milestones and game ends are applied last,
+        so a batch may contain the whole life of a game. The accounts of new
+        games are resolved all at once.
+        """
+        if self.games:
+            accounts = resolve_accounts(self.s, self.accounts.values())
+            for gid, row in self.games.items():
+                _set_game_account(row, self.accounts[gid], accounts)
+            self.counts["games_inserted"] += self.s.execute(
+                _insert_games_stmt, list(self.games.values())).rowcount
+        if self.milestones:
+            self.counts["milestones_inserted"] += self.s.execute(
+                _insert_milestones_stmt, self.milestones).rowcount
+        if self.ends:
+            self.s.execute(_end_games_stmt, list(self.ends.values()))
+        self.games = {}
+        self.accounts = {}
+        self.ends = {}
+        self.milestones = []
 
-@_reraise_dberror
-def _end_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
-    g = _games(s, gid=data["gid"]).first()
-
-    g.end = modelutils.crawl_date_to_datetime(data["end"])
-    g.ktyp = get_ktyp(s, data["ktyp"])
-    g.score = data["sc"]
-    g.dam = data.get("dam", 0)
-    g.tdam = data.get("tdam", g.dam)
-    g.sdam = data.get("sdam", g.dam)
-    
 
 def get_logfile_progress(
     s: sqlalchemy.orm.session.Session, url: str
@@ -452,7 +740,7 @@ def get_logfile_progress(
     else:
         log = Logfile(source_url=url)
         s.add(log)
-        s.commit()
+        s.flush()
         return log
 
 
@@ -651,6 +939,7 @@ def setup_database():
             setup_ktyps(sess)
             setup_verbs(sess)
             setup_skills(sess)
+        load_dimensions(sess)
 
 def get_game(s: sqlalchemy.orm.session.Session, **kwargs: dict) -> Game:
     """Get a single game. See get_games docstring/type signature."""
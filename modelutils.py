@@ -8,18 +8,70 @@ from typing import Optional
 import orm
 import constants as const
 
-def logline_to_dict(logline: str) -> dict:
-    """Convert a logline into a sanitized dict"""
+# The logline fields that ingest reads, see model.EventBatch.add_event.
+# Passed to logline_to_dict so only these are kept in each event.
+EVENT_FIELDS = frozenset((
+    "v", "name", "char", "start", "time", "type", "milestone",
+    "xl", "sk", "sklev", "place", "br", "lvl", "god", "turn", "dur", "urune",
+    "potionsused", "scrollsused",
+    "end", "ktyp", "tmsg", "sc", "dam", "tdam", "sdam",
+))
+# Every byte but the field separators, see _logline_fields
+_NOT_SEPARATORS = bytes(c for c in range(256) if c not in b":=")
+# The separators of a well-formed line are a prefix of this
+_ALIGNED = b"=:" * 4096
+
+
+def _logline_fields(logline: str, fields: Optional[frozenset]=None) -> dict:
+    """Split a logline into its raw key/value fields.
+
+    Fields are separated by ':' and a literal colon in a value is escaped as
+    '::'. Once escaped colons are hidden, the separators of a well-formed
+    line alternate '=' and ':', so they can all be turned into '=' and the
+    whole line split once into alternating keys and values. Any other line
+    is split field by field: even with one '=' per ':' a field without '='
+    next to one with two would shift every key after them.
+
+    If fields is given only those keys are kept. The line is still split
+    whole, in C, but the other values are dropped as they are paired up
+    instead of being stored in the dict.
+    """
+    # xlog lines are C strings so they never contain a NUL
+    hidden = logline.replace("::", "\0") if "::" in logline else logline
+    separators = hidden.encode().translate(None, _NOT_SEPARATORS)
+    if not (len(separators) % 2 and _ALIGNED.startswith(separators)):
+        return _logline_fields_slow(hidden, fields)
+    tokens = hidden.replace(":", "=")
+    if hidden is not logline:
+        tokens = tokens.replace("\0", ":")
+    it = iter(tokens.split("="))
+    if fields is None:
+        return dict(zip(it, it))
+    return {k: v for k, v in zip(it, it) if k in fields}
+
+
+def _logline_fields_slow(logline: str, fields: Optional[frozenset]=None) -> dict:
+    """Split a malformed logline field by field, skipping broken fields."""
     data = {}
-    logline = logline.replace("::", "@@")
-    pairs = logline.split(':')
-    for p in pairs:
-        p = p.replace("@@",":")
-        keyval = p.split('=')
+    for p in logline.split(':'):
+        keyval = p.replace("\0", ":").split('=')
         try:
-            data[keyval[0]] = keyval[1]
+            if fields is None or keyval[0] in fields:
+                data[keyval[0]] = keyval[1]
         except IndexError as e:
-            logging.error('error "{}" in keyval "{}", logline "{}"'.format(e,keyval,logline))
+            # A line missing a required field ends up in the dead letters
+            logging.debug('error "{}" in keyval "{}", logline "{}"'.format(
+                e, keyval, logline.replace("\0", "::")))
+    return data
+
+
+def logline_to_dict(logline: str, fields: Optional[frozenset]=None) -> dict:
+    """Convert a logline into a sanitized dict
+
+    If fields is given (eg EVENT_FIELDS) the dict only holds those keys, plus
+    the ones derived from them.
+    """
+    data = _logline_fields(logline, fields)
     if "god" not in data:
         data["god"] = "GOD_NO_GOD"
 
@@ -40,16 +92,24 @@ def crawl_date_to_datetime(d: str) -> datetime.datetime:
     Note: crawl dates use a 0-indexed month... I think you can blame struct_tm
     for this.
     """
-    # Increment the month by one
-    d = d[:4] + "%02d" % (int(d[4:6]) + 1) + d[6:]
-    return datetime.datetime(
-        year=int(d[:4]),
-        month=int(d[4:6]),
-        day=int(d[6:8]),
-        hour=int(d[8:10]),
-        minute=int(d[10:12]),
-        second=int(d[12:14]),
-    )
+    # YYYYMMDDhhmmss, peeled off from the right
+    n = int(d[:14])
+    n, second = divmod(n, 100)
+    n, minute = divmod(n, 100)
+    n, hour = divmod(n, 100)
+    n, day = divmod(n, 100)
+    year, month = divmod(n, 100)
+    return datetime.datetime(year, month + 1, day, hour, minute, second)
+
+
+def datetime_to_crawl_date(d: datetime.datetime) -> str:
+    """Converts a datetime to a crawl date string, without the DST suffix.
+
+    The result compares with the first 14 characters of a crawl date in the
+    same order as the datetimes do.
+    """
+    return "%04d%02d%02d%02d%02d%02d" % (d.year, d.month - 1, d.day,
+        d.hour, d.minute, d.second)
 
 
 def _morgue_prefix(src: str, version: str) -> Optional[str]:
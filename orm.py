@@ -22,9 +22,16 @@ from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
 import enum
 import json
+from typing import Optional
 
 Base = declarative_base()
 
+
+def _name_key(context) -> str:
+    """Default name_key: crawl names are case-insensitive."""
+    return context.current_parameters["name"].lower()
+
+
 @characteristic.with_repr(["name"])  # pylint: disable=too-few-public-methods
 class Server(Base):
     """A DCSS server -- a source of logfiles/milestones.
@@ -43,6 +50,7 @@ class Account(Base):
 
     Columns:
         name: name of the account on the server
+        name_key: canonical (lowercase) name, used for lookups
         blacklisted: if the account has been blacklisted. Accounts started as
             streak griefers/etc are blacklisted.
     """
@@ -50,6 +58,8 @@ class Account(Base):
     __tablename__ = "accounts"
     id = Column(Integer, primary_key=True, nullable=False)  # type: int
     name = Column(String(20), nullable=False, index=True)  # type: str
+    name_key = Column(String(20), nullable=False,
+            default=_name_key)  # type: str
     server_id = Column(Integer, ForeignKey("servers.id"), nullable=False)  # type: int
     server = relationship("Server")
     blacklisted = Column(Boolean, nullable=False, default=False)  # type: bool
@@ -68,7 +78,10 @@ class Account(Base):
         """
         return self.name.lower()
 
-    __table_args__ = (UniqueConstraint("name", "server_id", name="name-server_id"),)
+    __table_args__ = (
+            UniqueConstraint("name", "server_id", name="name-server_id"),
+            Index("ix_accounts_name_key_server_id", name_key, server_id, unique=True),
+        )
 
 @characteristic.with_repr(["name"])  # pylint: disable=too-few-public-methods
 class Player(Base):
@@ -79,11 +92,14 @@ class Player(Base):
             make up the player. In future, it could be changed so that
             differently-named accounts can make up a single player (eg
             Sequell nick mapping).
+        name_key: canonical (lowercase) name, used for lookups
     """
 
     __tablename__ = "players"
     id = Column(Integer, primary_key=True, nullable=False)  # type: int
     name = Column(String(20), unique=True, nullable=False)  # type: str
+    name_key = Column(String(20), nullable=False, index=True, unique=True,
+            default=_name_key)  # type: str
     accounts = relationship("Account", back_populates="player")  # type: list
 
     @property
@@ -369,6 +385,10 @@ class Milestone(Base):
         skill_id
         sklev
         verb_id
+        msg
+
+    (gid, time, verb_id, turn, msg) is unique, so importing the same lines
+    twice doesn't duplicate them.
     """
 
     __tablename__ = "milestones"
@@ -404,6 +424,9 @@ class Milestone(Base):
     __table_args__ = (
             # Used to get milestones in order (and find the latest ones)
             Index("ix_milestones_gid_time", gid, time),
+            # The natural key, see the docstring
+            Index("ix_milestones_natural_key", gid, time, verb_id, turn, msg,
+                unique=True),
         )
 
     def as_dict(self) -> dict:
@@ -432,10 +455,17 @@ class Logfile(Base):
     Columns:
         source_url: logfile source url
         current_key: the key of the next logfile event to import.
+        head_hash: hash of the first bytes of the file, up to current_key
+        tail_hash: hash of the last bytes before current_key
+            The hashes identify the file that current_key points into, so
+            a truncated or rewritten file can be noticed. Null until the
+            first import.
     """
     __tablename__ = 'logfile'
     source_url = Column(String(1000), primary_key=True)
     current_key = Column(Integer, default=0, nullable=False)
+    head_hash = Column(String(40), nullable=True)
+    tail_hash = Column(String(40), nullable=True)
 
     def __repr__(self):
         return "<Logfile(source_url={logfile.source_url}, offset={logfile.current_key})>".format(logfile=self)
@@ -452,17 +482,166 @@ class CsdcContestant(Base):
 
 # End Object defs
 
+engine = None
 session_factory = None
-
-def initialize(uri):
-    engine = create_engine(uri)
-    global session_factory 
+# The current session of each thread, see get_session
+_sessions = None  # type: Optional[scoped_session]
+# Connections kept open by the pool of a SQLite file database
+POOL_SIZE = 5
+
+# SQLite pragmas set on every new connection, in this order. busy_timeout
+# comes first so the others wait for locks instead of failing.
+PRAGMAS = ("busy_timeout", "journal_mode", "synchronous", "cache_size",
+        "mmap_size", "temp_store")
+# Named pragma profiles, see initialize. WAL lets pages be rendered from the
+# database while a refresh writes to it. cache_size is in KiB when negative.
+PROFILES = {
+    "default": {
+        "busy_timeout": 10000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 << 20,
+        "temp_store": "MEMORY",
+    },
+    # For backfills. A commit may be lost if the machine (not the process)
+    # crashes, which only means re-importing from the previous offset, as
+    # offsets are committed with the rows they cover.
+    "bulk load": {
+        "busy_timeout": 10000,
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -512 * 1024,
+        "mmap_size": 1 << 30,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def profile_pragmas(profile: str="default", overrides: Optional[dict]=None) -> dict:
+    """The pragmas of a named profile, with overrides applied."""
+    if profile not in PROFILES:
+        raise ValueError("Unknown database profile '{}', expected one of {}".format(
+            profile, ", ".join(sorted(PROFILES))))
+    pragmas = dict(PROFILES[profile])
+    pragmas.update(overrides or {})
+    unknown = set(pragmas) - set(PRAGMAS)
+    if unknown:
+        raise ValueError("Unsupported pragmas: {}".format(", ".join(sorted(unknown))))
+    return pragmas
+
+
+def _set_pragmas(engine, pragmas: dict) -> None:
+    """Set pragmas on each new connection of a SQLite engine."""
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name in PRAGMAS:
+                if pragmas.get(name) is not None:
+                    cursor.execute("PRAGMA {} = {}".format(name, pragmas[name]))
+        finally:
+            cursor.close()
+
+
+def _add_column(engine, conn, table: Table, name: str) -> bool:
+    """Add a column missing from a table created by an older version.
+
+    Returns False if the column was already there.
+    """
+    if name in [c["name"] for c in sqlalchemy.inspect(engine).get_columns(table.name)]:
+        return False
+    conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table.name, name,
+        table.c[name].type.compile(dialect=engine.dialect)))
+    return True
+
+
+def _add_name_keys(engine) -> None:
+    """Add and fill name_key in databases created before it existed."""
+    for table in (Player.__table__, Account.__table__):
+        with engine.begin() as conn:
+            if not _add_column(engine, conn, table, "name_key"):
+                continue
+            conn.execute("UPDATE {} SET name_key = lower(name)".format(table.name))
+        for index in table.indexes:
+            if "name_key" in index.columns:
+                index.create(engine)
+
+
+def _add_milestone_key(engine) -> None:
+    """Drop duplicate milestones and add the natural key index.
+
+    For databases created before the index existed, where importing a file
+    twice could duplicate milestones. The oldest copy is kept.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    if "ix_milestones_natural_key" in [i["name"] for i in inspector.get_indexes("milestones")]:
+        return
+    with engine.begin() as conn:
+        conn.execute("""DELETE FROM milestones WHERE id NOT IN (
+            SELECT min(id) FROM milestones GROUP BY gid, time, verb_id, turn, msg)""")
+    for index in Milestone.__table__.indexes:
+        if index.name == "ix_milestones_natural_key":
+            index.create(engine)
+
+
+def initialize(uri, pragmas: Optional[dict]=None):
+    """Connect to the database, creating or upgrading its tables.
+
+    pragmas are set on every SQLite connection, see profile_pragmas. By
+    default those of the "default" profile; pass {} to leave SQLite's own.
+    Calling it again disposes of the previous engine's connections.
+    """
+    global engine, session_factory, _sessions
+    if engine is not None:
+        _sessions.remove()
+        engine.dispose()
+    engine = _create_engine(uri)
+    _set_pragmas(engine, profile_pragmas() if pragmas is None else pragmas)
     session_factory = sessionmaker(bind=engine, expire_on_commit=False, autocommit=False)
+    _sessions = scoped_session(session_factory)
     Base.metadata.create_all(engine)
+    _add_name_keys(engine)
+    _add_milestone_key(engine)
+    with engine.begin() as conn:
+        for name in ("head_hash", "tail_hash"):
+            _add_column(engine, conn, Logfile.__table__, name)
+
+
+def _create_engine(uri):
+    """An engine whose connections are pooled and reused.
+
+    SQLAlchemy opens a new connection for every checkout of a SQLite file
+    database by default. Here they are kept in a QueuePool instead, and may
+    be returned from a different thread than the one that opened them.
+    """
+    url = sqlalchemy.engine.url.make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        return create_engine(uri, poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=POOL_SIZE, connect_args={"check_same_thread": False})
+    return create_engine(uri, pool_pre_ping=True)
+
 
 @contextmanager
 def get_session():
-    global session_factory
-    Session = scoped_session(session_factory)
-    yield Session()
-    Session.remove()
+    """A session that commits on exit, or rolls back if an error escapes.
+
+    Sessions are per thread. Inside another get_session() block of the same
+    thread, that block's session is returned and it commits or rolls back,
+    so a unit of work such as building a page uses one session throughout.
+    """
+    if _sessions.registry.has():
+        yield _sessions()
+        return
+    sess = _sessions()
+    try:
+        yield sess
+        sess.commit()
+    except BaseException:
+        sess.rollback()
+        raise
+    finally:
+        _sessions.remove()
@@ -0,0 +1,167 @@
+"""Run ingest stages in threads connected by bounded queues.
+
+A pipeline is a list of stages. The first stage is called with no arguments
+and returns an iterator of batches, each following stage is called with the
+iterator of its upstream batches and returns its own. The last stage runs in
+the calling thread and just consumes its input.
+
+Queues between stages hold at most queue_size batches, so a slow stage
+applies backpressure to the ones before it instead of letting them buffer
+the whole input in memory.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterator, Optional, Sequence
+
+# Batches that may wait between two stages
+QUEUE_SIZE = 4
+# How often blocked stages check whether the pipeline was aborted
+_POLL = 0.1
+
+_END = object()
+
+
+class Stage:
+    """A pipeline stage and its throughput counters.
+
+    Attributes:
+        name: name used in logs
+        func: the stage function, see the module docstring
+        size: function giving the number of items in a batch
+        items: items the stage produced (or consumed, for the last stage)
+        batches: batches the stage produced (or consumed)
+        waited: seconds spent blocked on the neighbouring queues
+        elapsed: seconds between the stage starting and finishing
+    """
+
+    def __init__(self, name: str, func: Callable,
+            size: Callable=len) -> None:
+        self.name = name
+        self.func = func
+        self.size = size
+        self.items = 0
+        self.batches = 0
+        self.waited = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def busy(self) -> float:
+        """Seconds the stage spent doing its own work."""
+        return max(self.elapsed - self.waited, 0.0)
+
+    @property
+    def rate(self) -> float:
+        """Items per busy second."""
+        return self.items / self.busy if self.busy else 0.0
+
+    def count(self, batch) -> None:
+        self.batches += 1
+        self.items += self.size(batch)
+
+    def __repr__(self) -> str:
+        return "<Stage({s.name}, items={s.items}, batches={s.batches}, busy={s.busy:.2f}s, waited={s.waited:.2f}s)>".format(s=self)
+
+    def summary(self) -> str:
+        return "{s.name}: {s.items} items in {s.batches} batches, {s.busy:.2f}s busy, {s.waited:.2f}s waiting, {s.rate:.0f}/s".format(s=self)
+
+
+class _Aborted(Exception):
+    """The pipeline was stopped while a stage was blocked."""
+
+
+def _get(q: queue.Queue, stop: threading.Event, stage: Stage) -> Iterator:
+    """Iterate over the batches on q until the upstream stage is done."""
+    while True:
+        t_i = time.perf_counter()
+        while True:
+            try:
+                batch = q.get(timeout=_POLL)
+                break
+            except queue.Empty:
+                if stop.is_set():
+                    raise _Aborted
+        stage.waited += time.perf_counter() - t_i
+        if batch is _END:
+            return
+        yield batch
+
+
+def _put(q: queue.Queue, stop: threading.Event, stage: Optional[Stage], batch) -> None:
+    t_i = time.perf_counter()
+    while True:
+        try:
+            q.put(batch, timeout=_POLL)
+            break
+        except queue.Full:
+            if stop.is_set():
+                raise _Aborted
+    if stage is not None:
+        stage.waited += time.perf_counter() - t_i
+
+
+def _run_stage(stage: Stage, upstream: Optional[Iterator], out: queue.Queue,
+        stop: threading.Event, errors: list) -> None:
+    t_i = time.perf_counter()
+    try:
+        batches = stage.func() if upstream is None else stage.func(upstream)
+        for batch in batches:
+            stage.count(batch)
+            _put(out, stop, stage, batch)
+    except _Aborted:
+        pass
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        stage.elapsed = time.perf_counter() - t_i
+        try:
+            _put(out, stop, None, _END)
+        except _Aborted:
+            pass
+
+
+def run(stages: Sequence[Stage], queue_size: int=QUEUE_SIZE) -> Sequence[Stage]:
+    """Run the stages until the first one is exhausted.
+
+    Re-raises the first exception raised by any stage, after stopping the
+    others. Returns the stages, for their counters.
+    """
+    stop = threading.Event()
+    errors = []  # type: list
+    threads = []
+    upstream = None  # type: Optional[Iterator]
+    for stage in stages[:-1]:
+        out = queue.Queue(queue_size)  # type: queue.Queue
+        t = threading.Thread(target=_run_stage, name=stage.name,
+                args=(stage, upstream, out, stop, errors), daemon=True)
+        threads.append(t)
+        upstream = _get(out, stop, stages[len(threads)])
+
+    last = stages[-1]
+    for t in threads:
+        t.start()
+    t_i = time.perf_counter()
+    try:
+        def counted():
+            for batch in upstream:
+                last.count(batch)
+                yield batch
+        last.func(counted())
+    except _Aborted:
+        pass
+    finally:
+        last.elapsed = time.perf_counter() - t_i
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return stages
+
+
+def log_summary(stages: Sequence[Stage], level: int=logging.INFO) -> None:
+    for stage in stages:
+        logging.log(level, stage.summary())
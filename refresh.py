@@ -1,66 +1,761 @@
 import orm
-from orm import Logfile
+from orm import Logfile, Milestone, Verb
 import sources
 import os
 import logging
 import time
+import mmap
+import hashlib
+import multiprocessing
+import queue
+import threading
 import modelutils
-from typing import Optional
+import pipeline
+import deadletter
+from deadletter import DeadLetters
+from ingeststats import IngestStats, source_name
+from typing import Callable, Iterable, Optional, Iterator, Tuple
 from model import (
-    get_logfile_progress, 
-    save_logfile_progress, 
-    add_event
+    get_logfile_progress,
+    save_logfile_progress,
+    clear_caches,
+    EventBatch,
+    DBError
 )
 
-def _refresh_from_file(file, src, sess):
-    logging.debug(file)
-    logfile = get_logfile_progress(sess, file)
-    logging.info("Refreshing from: {}".format(file))
+# Number of milestone rows written (and committed) at a time
+BATCH_SIZE = 1000
+# Number of lines read from a logfile at a time
+READ_BATCH_SIZE = 1000
+# Bytes hashed at each end of the imported part of a file, see Logfile
+IDENTITY_BYTES = 1024
+# Errors from normalising an event that mean the line itself is bad, rather
+# than the database. Such lines go to the dead letters, see deadletter.
+BAD_LINE_ERRORS = (KeyError, ValueError, TypeError, IndexError, AttributeError)
+# Downloaded bytes held in memory per file waiting to be read, past that
+# they are read back from the file, see _Tail
+TAIL_BUFFER_BYTES = 16 << 20
 
-    with open(logfile.source_url, 'rb') as f:
-        logging.debug('offset: {}'.format(logfile.current_key))
-        f.seek(logfile.current_key)
-        iter = 0
-        for line in f:
+class TournamentFilter:
+    """Decide from a raw logfile line whether its game can ever score.
+
+    A game can only score in a week if its char is the week's combo and it
+    started inside the week's window. Every milestone and logfile line
+    carries the game's char and start, so each line can be checked on its
+    own, before it is decoded and parsed. Lines without a char or start are
+    kept.
+
+    Instances are callable and picklable, so they can be passed to worker
+    processes.
+    """
+
+    def __init__(self, windows: Iterable[Tuple[str, str, str]]) -> None:
+        """windows are (char, first start, last start), crawl date strings."""
+        self.windows = {}  # type: dict
+        for char, lo, hi in windows:
+            self.windows.setdefault(char.encode(), []).append(
+                (lo.encode(), hi.encode()))
+
+    @classmethod
+    def from_weeks(cls, weeks: Iterable) -> 'TournamentFilter':
+        return cls((wk.species.short + wk.background.short,
+                modelutils.datetime_to_crawl_date(wk.start),
+                modelutils.datetime_to_crawl_date(wk.end))
+            for wk in weeks)
+
+    def __call__(self, line: bytes) -> bool:
+        i = line.find(b":char=")
+        j = line.find(b":start=")
+        if i < 0 or j < 0:
+            return True
+        i += 6
+        windows = self.windows.get(line[i:line.find(b":", i)])
+        if windows is None:
+            return False
+        start = line[j + 7:j + 21]
+        for lo, hi in windows:
+            if lo <= start <= hi:
+                return True
+        return False
+
+
+def _read_lines(files: list, batch_size: int=READ_BATCH_SIZE,
+        keep: Optional[Callable[[bytes], bool]]=None,
+        stats: Optional[IngestStats]=None) -> Iterator[Tuple[str, list, list, int, bool]]:
+    """Read event lines from each (file, offset) in files, in order.
+
+    Files are memory-mapped and scanned for newlines from offset, only lines
+    starting with 'v=1.' (and accepted by keep, if given) are copied out. A
+    trailing line without a newline is still being written, it is left for
+    the next refresh.
+
+    Yields (file, lines, starts, offset, eof) for every batch_size lines,
+    where starts are the lines' offsets and offset is the position just after
+    the last line scanned. The last batch of each file has eof set and may be
+    empty.
+    """
+    stats = stats or IngestStats()
+    for file, offset in files:
+        lines, starts = [], []
+        counts = stats.file(file)
+        logging.debug('offset: {}'.format(offset))
+        t_i = time.perf_counter()
+        start, seen = offset, 0
+        if not os.path.exists(file):
+            # Never downloaded, e.g. the server is down
+            yield file, lines, starts, offset, True
+            continue
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > offset:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    find = m.find
+                    while True:
+                        end = find(b"\n", offset)
+                        if end < 0:
+                            break
+                        end += 1
+                        seen += 1
+                        if m[offset:offset + 4] == b"v=1.":
+                            line = m[offset:end]
+                            if keep is None or keep(line):
+                                lines.append(line)
+                                starts.append(offset)
+                        offset = end
+                        if len(lines) >= batch_size:
+                            counts.update(bytes_read=offset - start,
+                                lines_seen=seen,
+                                read_s=time.perf_counter() - t_i)
+                            yield file, lines, starts, offset, False
+                            t_i = time.perf_counter()
+                            start, seen = offset, 0
+                            lines, starts = [], []
+        counts.update(bytes_read=offset - start, lines_seen=seen,
+            read_s=time.perf_counter() - t_i)
+        yield file, lines, starts, offset, True
+
+
+class _Tail:
+    """The bytes a download appends to one file, as they arrive.
+
+    A sink for sources.download_file, iterating over it yields
+    (offset, chunk) until the download is over. An empty chunk only means
+    the file has been written up to offset: files that aren't being read
+    yet keep at most TAIL_BUFFER_BYTES in memory. An offset of None means
+    the file was replaced by a new copy, which has been written whole.
+    """
+
+    def __init__(self) -> None:
+        self.queue = queue.Queue()  # type: queue.Queue
+        self.lock = threading.Lock()
+        self.buffered = 0
+
+    def data(self, offset: int, chunk: bytes) -> None:
+        with self.lock:
+            keep = self.buffered + len(chunk) <= TAIL_BUFFER_BYTES
+            if keep:
+                self.buffered += len(chunk)
+        if keep:
+            self.queue.put((offset, chunk))
+        else:
+            self.queue.put((offset + len(chunk), b""))
+
+    def replaced(self) -> None:
+        self.queue.put((None, b""))
+
+    def done(self) -> None:
+        self.queue.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[Optional[int], bytes]]:
+        for offset, chunk in iter(self.queue.get, None):
+            with self.lock:
+                self.buffered -= len(chunk)
+            yield offset, chunk
+
+
+def _file_blocks(file: str, start: int, end: Optional[int]=None) -> Iterator[bytes]:
+    """Read file from start to end (or its end) in blocks."""
+    if not os.path.exists(file):
+        return
+    with open(file, 'rb') as f:
+        f.seek(start)
+        while end is None or start < end:
+            block = f.read(1 << 20 if end is None else min(1 << 20, end - start))
+            if not block:
+                break
+            start += len(block)
+            yield block
+
+
+def _tail_blocks(file: str, offset: int, tail: _Tail) -> Iterator[Optional[bytes]]:
+    """The bytes of file from offset on, following its download.
+
+    Bytes that were in the file before the download appended to it are
+    read from the file, the rest are taken from the download as it goes.
+    If the file was replaced by a new copy, None is yielded and the new
+    copy follows from its start, as offset means nothing in it.
+    """
+    pos = offset
+    for at, chunk in tail:
+        if at is None:
+            pos = 0
+            yield None
+            continue
+        if at > pos:
+            for block in _file_blocks(file, pos, at):
+                pos += len(block)
+                yield block
+        if at + len(chunk) > pos:
+            yield chunk[pos - at:]
+            pos = at + len(chunk)
+    for block in _file_blocks(file, pos):
+        pos += len(block)
+        yield block
+
+
+def _stream_lines(files: list, tails: dict, batch_size: int=READ_BATCH_SIZE,
+        keep: Optional[Callable[[bytes], bool]]=None,
+        stats: Optional[IngestStats]=None) -> Iterator[Tuple[str, list, list, int, bool]]:
+    """Like _read_lines, but following each file's download in tails.
+
+    Lines are split out of the downloaded bytes as they arrive, so parsing
+    and writing overlap the download and the new part of a file isn't read
+    back from disk. read_s includes waiting for the download.
+    """
+    stats = stats or IngestStats()
+    for file, offset in files:
+        lines, starts = [], []
+        counts = stats.file(file)
+        t_i = time.perf_counter()
+        start, seen = offset, 0
+        buf = b""
+        for block in _tail_blocks(file, offset, tails[file]):
+            if block is None:
+                # Replaced, lines imported from the old copy are skipped
+                # on insert
+                logging.warning("{} was replaced by a new copy, importing "
+                    "it again".format(file))
+                counts.update(bytes_read=offset - start, lines_seen=seen)
+                buf, offset, start, seen = b"", 0, 0, 0
+                lines, starts = [], []
+                continue
+            buf += block
+            i = 0
+            while True:
+                end = buf.find(b"\n", i)
+                if end < 0:
+                    break
+                end += 1
+                seen += 1
+                if buf.startswith(b"v=1.", i):
+                    line = buf[i:end]
+                    if keep is None or keep(line):
+                        lines.append(line)
+                        starts.append(offset + i)
+                i = end
+            buf = buf[i:]
+            offset += i
+            if len(lines) >= batch_size:
+                counts.update(bytes_read=offset - start, lines_seen=seen,
+                    read_s=time.perf_counter() - t_i)
+                yield file, lines, starts, offset, False
+                t_i = time.perf_counter()
+                start, seen = offset, 0
+                lines, starts = [], []
+        counts.update(bytes_read=offset - start, lines_seen=seen,
+            read_s=time.perf_counter() - t_i)
+        yield file, lines, starts, offset, True
+
+
+def _parse_lines(batches: Iterator, src_names: dict, dead: DeadLetters,
+        batch_size: int=BATCH_SIZE,
+        stats: Optional[IngestStats]=None) -> Iterator[Tuple[str, list, list, int]]:
+    """Parse batches of lines from _read_lines into events.
+
+    src_names maps each file to its source's name. Lines that can't be
+    parsed are sent to dead. Yields (file, events, starts, offset) once at
+    least batch_size events have been parsed, and at the end of each file,
+    with dead flushed.
+    """
+    stats = stats or IngestStats()
+    events, event_starts = [], []
+    for file, lines, starts, offset, eof in batches:
+        src_name = src_names[file]
+        t_i = time.perf_counter()
+        errors = 0
+        for line, start in zip(lines, starts):
             try:
-                decoded_line = line.decode()
-                if(decoded_line[0:4] == "v=1."):
-                    data = modelutils.logline_to_dict(decoded_line)
-                    data["src_abbr"] = src.name
-                    if not ('type' in data and data['type'] == 'crash'):
-                        add_event(sess, data)
-            except KeyError as e:
-                logging.error('key {} not found'.format(e))
-            except Exception as e:  # how scandalous! Don't want one broken line to break everything
-                logging.exception('Something unexpected happened, skipping this event')
-            iter += 1
-            logfile.current_key += len(line)
-            if iter % 1000 == 0:  # don't spam commits
-                sess.commit()
-        logfile.current_key = f.tell()
-        sess.commit()
+                data = modelutils.logline_to_dict(line.decode(),
+                    modelutils.EVENT_FIELDS)
+                data["src_abbr"] = src_name
+                if not ('type' in data and data['type'] == 'crash'):
+                    events.append(data)
+                    event_starts.append(start)
+            except Exception as e:  # Don't want one broken line to break everything
+                errors += 1
+                dead.add(file, start, line, e)
+        stats.add(file, lines_parsed=len(lines) - errors, parse_errors=errors,
+            parse_s=time.perf_counter() - t_i)
+        if len(events) >= batch_size or eof:
+            dead.flush()
+            yield file, events, event_starts, offset
+            events, event_starts = [], []
+
+
+def _bad_line(e: DBError) -> bool:
+    """Whether an error from EventBatch.add_event is down to the event."""
+    return isinstance(e.__cause__, BAD_LINE_ERRORS)
+
+
+def _write_events(sess, logfile: Logfile, events: list, starts: list,
+        offset: int, stats: IngestStats, dead: DeadLetters) -> None:
+    """Write a batch of parsed events and the logfile offset they end at.
+
+    This is the ingest checkpoint: the rows and the offset are committed in
+    one transaction, so after a crash the next refresh resumes exactly after
+    the last batch that made it to the database. Events that can't be
+    normalised are sent to dead, which is flushed before the commit.
+    """
+    file = logfile.source_url
+    if not events and offset == logfile.current_key:
+        return
+    try:
+        batch = EventBatch(sess)
+        rejected = 0
+        with stats.timer(file, "lookup_s"):
+            for data, start in zip(events, starts):
+                try:
+                    batch.add_event(data)
+                except DBError as e:
+                    if not _bad_line(e):
+                        raise
+                    rejected += 1
+                    dead.add(file, start, deadletter.read_line(file, start),
+                        e.__cause__)
+        with stats.timer(file, "flush_s"):
+            batch.flush()
+        logfile.current_key = offset
+        logfile.head_hash, logfile.tail_hash = _file_identity(file, offset)
+        dead.flush()
+        with stats.timer(file, "commit_s"):
+            sess.commit()
+        stats.add(file, events=len(events) - rejected,
+            events_rejected=rejected, commits=1, **batch.counts)
+    except BaseException:
+        sess.rollback()
+        clear_caches()
+        raise
+
+
+def _file_identity(file: str, offset: int) -> Tuple[Optional[str], Optional[str]]:
+    """Hash the first and the last IDENTITY_BYTES before offset."""
+    if offset <= 0:
+        return None, None
+    with open(file, 'rb') as f:
+        head = f.read(min(offset, IDENTITY_BYTES))
+        f.seek(max(0, offset - IDENTITY_BYTES))
+        tail = f.read(offset - f.tell())
+    return hashlib.sha1(head).hexdigest(), hashlib.sha1(tail).hexdigest()
+
+
+def _file_changed(logfile: Logfile) -> Optional[str]:
+    """Check that the imported part of a file is still what was imported.
+
+    Returns a description of the problem, or None. A file that shrank below
+    the saved offset was truncated or rotated, one whose hashes don't match
+    was rewritten.
+    """
+    file, offset = logfile.source_url, logfile.current_key
+    if not offset or not os.path.isfile(file):
+        return None
+    size = os.stat(file).st_size
+    if size < offset:
+        return "shrank to {} bytes, below offset {}".format(size, offset)
+    with open(file, 'rb') as f:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            return "offset {} is not at the start of a line".format(offset)
+    if logfile.head_hash is None:
+        return None
+    head, tail = _file_identity(file, offset)
+    if head != logfile.head_hash:
+        return "was replaced by a different file"
+    if tail != logfile.tail_hash:
+        return "was rewritten before offset {}".format(offset)
+    return None
+
+
+def _source_files(src: os.DirEntry, source_data: dict) -> list:
+    """List a source's files in the order they must be ingested."""
+    expected_files = [sources.url_to_filename(x) for _, x in
+            source_data[src.name].items()]
+    logging.debug('scanning {} files, expect [{}]'.format(src.name, ','.join(expected_files)))
+    # it is important that this refresh first so we get begins
+    # before ends!
+    milestones = os.path.join(src.path,
+        sources.url_to_filename(source_data[src.name]["milestones"]))
+    logfile = os.path.join(src.path,
+        sources.url_to_filename(source_data[src.name]["logfile"]))
+    return [milestones, logfile]
+
+
+def _progress(srcs: list, source_data: dict, sess) -> Tuple[dict, dict]:
+    """Get the import progress of every file of srcs.
+
+    Returns ({file: Logfile}, {src_name: [(file, offset), ...]}).
+    """
+    logfiles = {}
+    src_files = {}
+    for src in srcs:
+        src_files[src.name] = []
+        for file in _source_files(src, source_data):
+            logging.info("Refreshing from: {}".format(file))
+            logfiles[file] = get_logfile_progress(sess, file)
+            problem = _file_changed(logfiles[file])
+            if problem:
+                # Lines that were already imported are skipped on insert
+                logging.warning("{} {}, importing it again".format(file, problem))
+                logfiles[file].current_key = 0
+            src_files[src.name].append((file, logfiles[file].current_key))
+    sess.commit()
+    return logfiles, src_files
+
+
+def _up_to_date(srcs: list, source_data: dict, sess) -> bool:
+    """Whether every file of srcs has been imported to its end."""
+    files = {file: os.path.getsize(file) for src in srcs
+        for file in _source_files(src, source_data) if os.path.exists(file)}
+    offsets = dict(sess.query(Logfile.source_url, Logfile.current_key)
+        .filter(Logfile.source_url.in_(list(files))))
+    return all(offsets.get(file) == size for file, size in files.items())
+
+
+def _batch_size(batch: tuple) -> int:
+    return len(batch[1])
+
+
+def _refresh_pipelined(srcs: list, source_data: dict, sess, batch_size: int,
+        read_batch_size: int, queue_size: int,
+        keep: Optional[Callable[[bytes], bool]], stats: IngestStats,
+        dead: DeadLetters, download: Optional[Callable[[dict], None]]=None) -> None:
+    """Read, parse and write in separate threads.
+
+    Reading and parsing carry on while the writer waits on the database, up
+    to queue_size batches ahead. If download is given, it is called in
+    another thread with a _Tail for every file, and lines are read from the
+    downloads as they go, see _stream_lines.
+    """
+    logfiles, src_files = _progress(srcs, source_data, sess)
+    files = [f for src in srcs for f in src_files[src.name]]
+    src_names = {file: name for name, fs in src_files.items() for file, _ in fs}
+    if download is None:
+        read = lambda: _read_lines(files, read_batch_size, keep, stats)
+    else:
+        tails = {file: _Tail() for file, _ in files}
+
+        def fetch():
+            try:
+                download(tails)
+            except Exception:
+                logging.exception("Downloading failed")
+            finally:
+                for tail in tails.values():
+                    tail.done()
+
+        fetcher = threading.Thread(target=fetch, name="download", daemon=True)
+        fetcher.start()
+        read = lambda: _stream_lines(files, tails, read_batch_size, keep, stats)
+
+    def write(batches):
+        for file, events, starts, offset in batches:
+            _write_events(sess, logfiles[file], events, starts, offset,
+                stats, dead)
+
+    stages = pipeline.run([
+        pipeline.Stage("read", read, size=_batch_size),
+        pipeline.Stage("parse",
+            lambda batches: _parse_lines(batches, src_names, dead, batch_size,
+                stats),
+            size=_batch_size),
+        pipeline.Stage("write", write, size=_batch_size),
+    ], queue_size)
+    pipeline.log_summary(stages)
+    if download is not None:
+        fetcher.join()
+
+
+def _parse_source(queue, src_name: str, files: list, batch_size: int,
+        read_batch_size: int,
+        keep: Optional[Callable[[bytes], bool]]) -> Tuple[IngestStats, DeadLetters]:
+    """Parse a source's files in a worker process.
+
+    Batches are put on queue as (file, events, starts, offset), in file
+    order. A final (src_name, None, None, None) marks the source as done,
+    even on error. Returns the read and parse stats, and the dead letters,
+    which have been written already.
+    """
+    stats = IngestStats()
+    dead = DeadLetters()
+    try:
+        src_names = {file: src_name for file, _ in files}
+        for batch in _parse_lines(
+                _read_lines(files, read_batch_size, keep, stats),
+                src_names, dead, batch_size, stats):
+            queue.put(batch)
+    finally:
+        queue.put((src_name, None, None, None))
+    return stats, dead
+
+
+def _refresh_parallel(srcs: list, source_data: dict, sess, batch_size: int,
+        read_batch_size: int, queue_size: int, processes: int,
+        keep: Optional[Callable[[bytes], bool]], stats: IngestStats,
+        dead: DeadLetters) -> None:
+    """Parse sources in worker processes and write them from this one.
+
+    Each worker handles a whole source, so milestones are still written
+    before the logfile of the same source.
+    """
+    logfiles, src_files = _progress(srcs, source_data, sess)
+    jobs = []
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue(queue_size)
+        p = multiprocessing.Pool(min(processes, len(srcs)))  # type: ignore
+        try:
+            for src in srcs:
+                jobs.append(p.apply_async(_parse_source,
+                    (queue, src.name, src_files[src.name], batch_size,
+                        read_batch_size, keep)))
+            running = len(jobs)
+            while running:
+                file, events, starts, offset = queue.get()
+                if events is None:
+                    running -= 1
+                    continue
+                _write_events(sess, logfiles[file], events, starts, offset,
+                    stats, dead)
+            p.close()
+            for job in jobs:
+                job_stats, job_dead = job.get()
+                stats.merge(job_stats)
+                dead.merge(job_dead)
+        finally:
+            p.terminate()
+            p.join()
+
 
 # fetch newest data into the DB
-def refresh(sources_file: str, sources_dir: str, fetch: Optional[bool]=True):
+def refresh(sources_file: str, sources_dir: str, fetch: Optional[bool]=True,
+        batch_size: int=BATCH_SIZE, processes: int=1,
+        read_batch_size: int=READ_BATCH_SIZE,
+        queue_size: int=pipeline.QUEUE_SIZE,
+        keep: Optional[Callable[[bytes], bool]]=None,
+        stats_file: Optional[str]=None, stream: bool=False,
+        connections: Optional[sources.Connections]=None) -> IngestStats:
+    """Ingest new logfile lines from every source.
+
+    Lines are read, parsed and written in a pipeline of threads, see
+    _refresh_pipelined. With processes > 1, lines are instead parsed in that
+    many worker processes and written to the database from this process.
+
+    Parameters:
+        batch_size: events written and committed at a time
+        read_batch_size: lines read from a file at a time
+        queue_size: batches that may wait between two stages
+        keep: if given, only raw lines for which keep(line) is true are
+            imported, e.g. a TournamentFilter. Must be picklable when
+            processes > 1.
+        stats_file: if given, the stats are also written there as JSON,
+            with the sources' download health when fetching
+        stream: with fetch and processes == 1, import new bytes as they are
+            downloaded instead of after every download is done
+        connections: a sources.Connections to download with, e.g. kept
+            open between refreshes
+
+    Lines that can't be parsed or normalised are skipped and kept in each
+    source's dead-letter file, see deadletter and replay_dead_letters.
+
+    If fetch found nothing new upstream and every file has been imported to
+    its end, nothing else is done.
+
+    Returns:
+        the refresh's IngestStats, which are also logged.
+    """
     t_i = time.time()
     source_data = sources.source_data(sources_file)
 
+    stream = stream and fetch and processes <= 1
+    downloaded = None
+    health = sources.SourceHealth.load(
+        os.path.join(sources_dir, sources.HEALTH_FILE))
+    if stream:
+        for name in source_data:
+            os.makedirs(os.path.join(sources_dir, name), exist_ok=True)
+    elif fetch:
+        downloaded = sources.download_sources(sources_file, sources_dir,
+            connections=connections, health=health)
+
+    def download(tails):
+        sources.download_sources(sources_file, sources_dir,
+            connections=connections, sinks=tails, health=health)
+
+    srcs = [src for src in os.scandir(sources_dir)
+            if not src.is_file() and src.name in source_data]
+    stats = IngestStats()
+    with orm.get_session() as sess, DeadLetters() as dead:
+        if (downloaded is not None and not any(downloaded.values())
+                and _up_to_date(srcs, source_data, sess)):
+            logging.info("Nothing new upstream")
+        elif processes > 1 and srcs:
+            _refresh_parallel(srcs, source_data, sess, batch_size,
+                    read_batch_size, queue_size, processes, keep, stats, dead)
+        elif srcs:
+            _refresh_pipelined(srcs, source_data, sess, batch_size,
+                    read_batch_size, queue_size, keep, stats, dead,
+                    download if stream else None)
+
+    stats.elapsed = time.time() - t_i
     if fetch:
-        sources.download_sources(sources_file, sources_dir)
+        stats.downloads = health.as_dict()
+    stats.log_summary()
+    if stats_file:
+        stats.write_json(stats_file)
+    logging.info('Refreshed in {} seconds'.format(stats.elapsed))
+    return stats
+
+
+def replay_dead_letters(sources_dir: str) -> int:
+    """Import the lines in every dead-letter file under sources_dir again.
+
+    Meant for after the parser or the lines themselves have been fixed. Each
+    file is rewritten with only the lines that still fail, lines that were
+    imported already are skipped on insert.
+
+    Returns:
+        the number of lines still failing.
+    """
+    remaining = 0
+    with orm.get_session() as sess:
+        for dest in deadletter.files(sources_dir):
+            records = deadletter.read(dest)
+            failed = []
+            try:
+                batch = EventBatch(sess)
+                for r in records:
+                    try:
+                        data = modelutils.logline_to_dict(r["line"],
+                            modelutils.EVENT_FIELDS)
+                        data["src_abbr"] = source_name(r["file"])
+                        if data.get("type") != "crash":
+                            batch.add_event(data)
+                    except DBError as e:
+                        if not _bad_line(e):
+                            raise
+                        failed.append(deadletter.record(r["file"], r["offset"],
+                            r["line"], e.__cause__))
+                    except Exception as e:
+                        failed.append(deadletter.record(r["file"], r["offset"],
+                            r["line"], e))
+                batch.flush()
+                sess.commit()
+            except BaseException:
+                sess.rollback()
+                clear_caches()
+                raise
+            deadletter.rewrite(dest, failed)
+            logging.info("{}: {} of {} lines replayed".format(dest,
+                len(records) - len(failed), len(records)))
+            remaining += len(failed)
+    return remaining
+
+
+def _event_lines_before(file: str, offset: int,
+        keep: Optional[Callable[[bytes], bool]]=None) -> Iterator[Tuple[int, bytes]]:
+    """The event lines that end at or before offset, last first.
+
+    Yields (start, line). Lines that keep (see refresh) rejects were never
+    imported and are passed over.
+    """
+    with open(file, 'rb') as f:
+        if offset <= 0 or os.fstat(f.fileno()).st_size < offset:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            end = offset
+            while end > 0:
+                start = m.rfind(b"\n", 0, end - 1) + 1
+                if m[start:start + 4] == b"v=1.":
+                    line = m[start:end]
+                    if keep is None or keep(line):
+                        yield start, line
+                end = start
+
+
+def _dead_offsets(file: str) -> set:
+    """The offsets of file's lines that are in its dead-letter file."""
+    dest = deadletter.path(file)
+    if not os.path.isfile(dest):
+        return set()
+    return {r["offset"] for r in deadletter.read(dest) if r["file"] == file}
+
+
+def _checkpoint_problem(sess, logfile: Logfile,
+        keep: Optional[Callable[[bytes], bool]]=None) -> Optional[str]:
+    """Check one saved offset, see verify_checkpoints."""
+    file, offset = logfile.source_url, logfile.current_key
+    if not os.path.isfile(file):
+        return "file is missing"
+    problem = _file_changed(logfile)
+    if problem:
+        return "file " + problem
+    if offset == 0:
+        return None
+
+    dead = _dead_offsets(file)
+    src_name = os.path.basename(os.path.dirname(file))
+    for start, line in _event_lines_before(file, offset, keep):
+        if start in dead:
+            continue
+        # Lines that can't be parsed were skipped, crashes are dropped
+        try:
+            data = modelutils.logline_to_dict(line.decode())
+            if data.get("type") == "crash":
+                continue
+            gid = "%s:%s:%s" % (data["name"], src_name, data["start"])
+            # Logfile lines are death.final milestones, timed at their end.
+            # Their game may not have been imported, e.g. it began before
+            # the milestones file starts, so the game's end isn't checked.
+            event = data["type"]
+            q = sess.query(Milestone.id).join(Verb, Milestone.verb_id == Verb.id).filter(
+                Milestone.gid == gid,
+                Milestone.time == modelutils.crawl_date_to_datetime(data["time"]),
+                Verb.name == event)
+        except Exception:
+            continue
+        if not sess.query(q.exists()).scalar():
+            return "the {} event of {} before offset {} is not in the database".format(
+                event, gid, offset)
+        return None
+    return None
+
+
+def verify_checkpoints(keep: Optional[Callable[[bytes], bool]]=None) -> bool:
+    """Check every saved logfile offset against its file and the database.
+
+    An offset must fall at the start of a line inside the file, and the last
+    event before it must have been imported. keep must be the filter the
+    files were imported with, if any, see refresh. Problems are logged.
 
+    Returns:
+        True if all checkpoints are consistent.
+    """
+    ok = True
     with orm.get_session() as sess:
-        for src in os.scandir(sources_dir):
-            if not src.is_file() and src.name in source_data:
-                expected_files = [sources.url_to_filename(x) for _, x in
-                        source_data[src.name].items()]
-                logging.debug('scanning {} files, expect [{}]'.format(src.name, ','.join(expected_files)))
-                # it is important that this refresh first so we get begins
-                # before ends!
-                milestones = os.path.join(src.path,
-                    sources.url_to_filename(source_data[src.name]["milestones"]))
-                _refresh_from_file(milestones, src, sess)
-                logfile = os.path.join(src.path,
-                    sources.url_to_filename(source_data[src.name]["logfile"]))
-                _refresh_from_file(logfile, src, sess)
-
-    logging.info('Refreshed in {} seconds'.format(time.time() - t_i))
+        for logfile in sess.query(Logfile).order_by(Logfile.source_url):
+            problem = _checkpoint_problem(sess, logfile, keep)
+            if problem:
+                ok = False
+                logging.error("{}: {}".format(logfile.source_url, problem))
+            else:
+                logging.info("{}: ok at offset {}".format(
+                    logfile.source_url, logfile.current_key))
+    return ok
@@ -1,21 +1,48 @@
 """Parse Sequell's sources.yml file and download logfiles."""
 
-import multiprocessing
+import collections
+import concurrent.futures
+import contextlib
+import http.client
+import json
 import os
-import sys
-import subprocess
+import threading
+import time
 import urllib.parse
 import re
-import shlex
-from typing import Optional, Iterable, Sequence
+import zlib
+from typing import Optional, Iterable, Iterator, Sequence, Tuple
 import logging
 
 import yaml
 
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used without it
+    zstandard = None
+
 SIMULTANEOUS_DOWNLOADS = 10
-WGET_NAME = 'wget.exe' if sys.platform == 'win32' else 'wget'
-WGET_SOURCE_CMDLINE = ("%s --timeout 10 --no-verbose -c --tries 5 "
-                       "-O '{outfile}' '{url}'" % WGET_NAME)
+# Downloads from the same host at a time
+PER_HOST_DOWNLOADS = 2
+# Seconds to wait for a connection or for data
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_TRIES = 5
+# Bytes read from a response at a time
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+USER_AGENT = 'csdc-scoreboard'
+# Content codings asked for when a whole file is fetched
+ACCEPT_ENCODING = 'zstd, gzip' if zstandard is not None else 'gzip'
+# Saved in the download directory, see load_validators
+VALIDATORS_FILE = 'validators.json'
+# Saved in the download directory, see SourceHealth
+HEALTH_FILE = 'health.json'
+# Seconds a source is skipped after failing, doubling with every failure
+BACKOFF_BASE = 60
+BACKOFF_MAX = 6 * 3600
+# Seconds download_files waits for all downloads before going ahead
+# without the slow ones
+DOWNLOAD_DEADLINE = 60
 # Ignored stuff: sprint & zotdef games, dead servers
 IGNORED_FILES_REGEX = re.compile(
     r'(sprint|zotdef|rl.heh.fi|crawlus.somatika.net|nostalgia|mulch|squarelos|combo_god)'
@@ -68,40 +95,531 @@ def url_to_filename(url: str) -> str:
     return urllib.parse.urlparse(url).path.lstrip('/').replace('/', '-')
 
 
-def download_source_files(urls: Sequence, dest: str) -> None:
-    """Download logfile/milestone files for a single source."""
-    logging.debug("Downloading {} files to {}".format(len(urls), dest))
-    for url in urls:
-        destfile = os.path.join(dest, url_to_filename(url))
-        # Skip 0-byte files -- the source is assumed bad
-        if os.path.exists(destfile) and os.stat(destfile).st_size == 0:
-            continue
-        # logging.debug("Downloading {} to {}".format(url, destfile))
-        cmdline = shlex.split(
-            WGET_SOURCE_CMDLINE.format(
-                outfile=destfile, url=url))
-        logging.debug("Executing subprocess: {}".format(cmdline))
-        p = subprocess.run(cmdline,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
-        if p.returncode:
-            logging.warning("Couldn't download {}. Error: {}".format(url, p.stderr))
-            if b'ERROR 404' in p.stderr or b'ERROR 403' in p.stderr:
-                # Write a zero-byte file so we don't try it again in future
-                open(destfile, 'w').close()
+class DownloadError(Exception):
+    """A download failed with an HTTP status that won't go away on retry."""
+
+    def __init__(self, url: str, status: int, reason: str) -> None:
+        super().__init__("{} {} for {}".format(status, reason, url))
+        self.status = status
+
+
+class Connections:
+    """Keep-alive HTTP connections, pooled per host.
+
+    At most per_host connections to a host are in use at a time, get()
+    waits for one to be returned. Connections are reused for as long as
+    the server keeps them open. Thread-safe.
+    """
+
+    def __init__(self, per_host: int=PER_HOST_DOWNLOADS,
+            timeout: float=DOWNLOAD_TIMEOUT) -> None:
+        self.per_host = per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)  # type: dict
+        self._slots = {}  # type: dict
+
+    def _slot(self, key: tuple) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self._slots[key]
+
+    @contextlib.contextmanager
+    def get(self, scheme: str, netloc: str) -> Iterator[http.client.HTTPConnection]:
+        """A connection to netloc, returned to the pool unless it failed."""
+        key = (scheme, netloc)
+        with self._slot(key):
+            with self._lock:
+                conn = self._idle[key].pop() if self._idle[key] else None
+            if conn is None:
+                cls = (http.client.HTTPSConnection if scheme == 'https'
+                    else http.client.HTTPConnection)
+                conn = cls(netloc, timeout=self.timeout)
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            with self._lock:
+                self._idle[key].append(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def load_validators(path: str) -> dict:
+    """Load the saved validators, {url: {etag, last_modified, length}}.
+
+    They describe each file as of its last complete download: the ETag and
+    Last-Modified the server sent, and the file's length.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_validators(path: str, validators: dict) -> None:
+    # A copy, downloads left running may still be adding to it
+    validators = dict(validators)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(validators, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _conditional_headers(validator: Optional[dict], size: int) -> dict:
+    """If-None-Match/If-Modified-Since for a file that is still as saved."""
+    if not validator or validator.get('length') != size:
+        return {}
+    headers = {}
+    if validator.get('etag'):
+        headers['If-None-Match'] = validator['etag']
+    if validator.get('last_modified'):
+        headers['If-Modified-Since'] = validator['last_modified']
+    return headers
+
+
+def _decoder(url: str, encoding: str):
+    """A decompressobj for a Content-Encoding, or None for identity."""
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise DownloadError(url, 415, "unsupported Content-Encoding '%s'" % encoding)
+
+
+def _get(connections: Connections, url: str, destfile: str,
+        validators: dict, sink=None) -> Tuple[int, int, float]:
+    """GET url, appending to destfile from its current size.
+
+    A file that is fetched whole (there is no local copy yet) may come
+    compressed, see ACCEPT_ENCODING, and is decompressed as it arrives.
+    Resumed fetches ask for the identity coding, as byte ranges of a
+    compressed response are ranges of the compressed bytes.
+
+    Redirects are followed. A server that ignores the Range header sends
+    the whole file, which then replaces destfile. The request is
+    conditional on the validators saved for url, which are updated after a
+    complete download. See download_file for sink.
+
+    Returns:
+        (HTTP status, bytes written, seconds until the response)
+    """
+    original_url = url
+    for _ in range(MAX_REDIRECTS + 1):
+        size = os.path.getsize(destfile) if os.path.exists(destfile) else 0
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'User-Agent': USER_AGENT}
+        if size:
+            headers['Range'] = 'bytes=%d-' % size
+            headers['Accept-Encoding'] = 'identity'
         else:
-            logging.debug("Finished downloading {}.".format(url))
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        headers.update(_conditional_headers(validators.get(original_url), size))
+        with connections.get(parts.scheme, parts.netloc) as conn:
+            t_i = time.perf_counter()
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            latency = time.perf_counter() - t_i
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                logging.debug("{} redirected to {}".format(destfile, url))
+                continue
+            encoding = resp.getheader('Content-Encoding', 'identity')
+            if resp.status in (200, 206):
+                try:
+                    decoder = _decoder(url, encoding)
+                except DownloadError:
+                    resp.read()
+                    raise
+            if resp.status == 206:
+                content_range = resp.getheader('Content-Range', '')
+                if not content_range.startswith('bytes %d-' % size) or decoder:
+                    resp.read()
+                    raise DownloadError(url, resp.status,
+                        "unexpected Content-Range '%s' or coding '%s'" % (
+                            content_range, encoding))
+                written = _save(resp, destfile, 'ab', sink)
+            elif resp.status == 200 and not size:
+                # Nothing to lose, decoded straight into the file
+                written = _save(resp, destfile, 'ab', sink, decoder)
+            elif resp.status == 200:
+                # Written aside, so a failed download leaves the old file
+                written = _save(resp, destfile + '.part', 'wb', None, decoder)
+                os.replace(destfile + '.part', destfile)
+                if sink is not None:
+                    sink.replaced()
+            elif resp.status == 416 and (resp.getheader('ETag') or resp.getheader('Last-Modified')):
+                # Nothing past the end of the file we have, which is complete
+                resp.read()
+                written = 0
+            else:
+                resp.read()
+                if resp.status in (304, 416):
+                    return resp.status, 0, latency
+                raise DownloadError(url, resp.status, resp.reason)
+            validators[original_url] = {
+                'etag': resp.getheader('ETag'),
+                'last_modified': resp.getheader('Last-Modified'),
+                'length': os.path.getsize(destfile),
+            }
+            return resp.status, written, latency
+    raise DownloadError(url, 310, "too many redirects")
+
+
+def _save(resp: http.client.HTTPResponse, file: str, mode: str,
+        sink=None, decoder=None) -> int:
+    """Write a response body to file, decoded by decoder if given.
+
+    Returns the number of (decoded) bytes written.
+    """
+    written = 0
+    with open(file, mode) as f:
+        while True:
+            raw = resp.read(DOWNLOAD_CHUNK_SIZE)
+            chunk = raw
+            if decoder is not None:
+                chunk = decoder.decompress(raw) if raw else decoder.flush()
+            if chunk:
+                at = f.tell()
+                f.write(chunk)
+                written += len(chunk)
+                if sink is not None:
+                    f.flush()
+                    sink.data(at, chunk)
+            if not raw:
+                break
+    return written
+
+
+class SourceHealth:
+    """How each source's downloads have been going, kept in HEALTH_FILE.
+
+    For every source:
+        latency_s: seconds until the response of its last request
+        bytes_per_s: transfer rate of its last download with any data
+        bytes: bytes written by its last fetch
+        consecutive_failures: fetches in a row where a file failed
+        next_fetch: unix time before which the source is skipped
+        last_success, last_error, last_error_time
+        missing: {url: {failures, next_fetch, last_error}} for files that
+            got a 403 or 404
+
+    After a failure a source is left alone for BACKOFF_BASE seconds,
+    doubling up to BACKOFF_MAX. A fetch counts as failed if any of the
+    source's files failed, and a source that is failing gets a single try
+    per file. A 403 or 404 only backs off that file, the same way, so a file
+    that is briefly missing (e.g. while logs are rotated) doesn't hold up
+    the rest of its source. Thread-safe.
+    """
+
+    def __init__(self, states: Optional[dict]=None,
+            path: Optional[str]=None) -> None:
+        self.states = states or {}
+        self.path = path
+        self._lock = threading.Lock()
+        self._failed = set()  # type: set
+
+    @classmethod
+    def load(cls, path: str) -> 'SourceHealth':
+        """Load from path, which save() then writes to."""
+        if not os.path.exists(path):
+            return cls(path=path)
+        with open(path) as f:
+            return cls(json.load(f), path)
 
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            data = json.dumps(self.states, indent=1, sort_keys=True)
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(self.path + '.tmp', self.path)
 
-def download_sources(sources_yaml_path: str, dest: str, servers: Optional[str]=None) -> None:
+    def _state(self, source: str) -> dict:
+        if source not in self.states:
+            self.states[source] = {'latency_s': None, 'bytes_per_s': None,
+                'bytes': 0, 'consecutive_failures': 0, 'next_fetch': 0,
+                'last_success': None, 'last_error': None,
+                'last_error_time': None}
+        self.states[source].setdefault('missing', {})
+        return self.states[source]
+
+    def start(self) -> None:
+        """Start a new fetch of every source."""
+        with self._lock:
+            self._failed = set()
+            for state in self.states.values():
+                state['bytes'] = 0
+
+    def ready(self, source: str, url: Optional[str]=None) -> bool:
+        """Whether source, and url if given, may be fetched now."""
+        with self._lock:
+            state = self._state(source)
+            now = time.time()
+            if url in state['missing'] and state['missing'][url]['next_fetch'] > now:
+                return False
+            return state['next_fetch'] <= now
+
+    def tries(self, source: str) -> int:
+        with self._lock:
+            return 1 if self._state(source)['consecutive_failures'] else DOWNLOAD_TRIES
+
+    def success(self, source: str, latency: float, seconds: float,
+            written: int, url: Optional[str]=None) -> None:
+        with self._lock:
+            state = self._state(source)
+            state['missing'].pop(url, None)
+            state['latency_s'] = latency
+            state['bytes'] += written
+            if written and seconds > 0:
+                state['bytes_per_s'] = written / seconds
+            if source not in self._failed:
+                state['consecutive_failures'] = 0
+                state['next_fetch'] = 0
+                state['last_success'] = time.time()
+
+    def failure(self, source: str, error: str, permanent: bool=False,
+            url: Optional[str]=None) -> None:
+        """Record a failed download.
+
+        permanent failures (a 403 or 404) back off url alone, others the
+        whole source.
+        """
+        with self._lock:
+            state = self._state(source)
+            state['last_error'] = error
+            state['last_error_time'] = time.time()
+            if permanent and url is not None:
+                missing = state['missing'].setdefault(url, {'failures': 0})
+                missing['failures'] += 1
+                missing['last_error'] = error
+                backoff = _backoff(missing['failures'])
+                missing['next_fetch'] = time.time() + backoff
+                logging.warning("Skipping {} for {} seconds after {} failures".format(
+                    url, backoff, missing['failures']))
+                return
+            if source in self._failed:
+                return
+            self._failed.add(source)
+            state['consecutive_failures'] += 1
+            backoff = _backoff(state['consecutive_failures'])
+            state['next_fetch'] = time.time() + backoff
+            logging.warning("Skipping source {} for {} seconds after {} failures".format(
+                source, backoff, state['consecutive_failures']))
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {source: dict(state, missing={url: dict(m)
+                    for url, m in state.get('missing', {}).items()})
+                for source, state in self.states.items()}
+
+    def log_summary(self, level: int=logging.INFO) -> None:
+        for source, state in sorted(self.as_dict().items()):
+            logging.log(level, "{}: {} bytes, latency {}, {} bytes/s, {} failures{}{}".format(
+                source, state['bytes'],
+                "-" if state['latency_s'] is None else "{:.3f}s".format(state['latency_s']),
+                "-" if state['bytes_per_s'] is None else int(state['bytes_per_s']),
+                state['consecutive_failures'],
+                ", {} missing files".format(len(state['missing']))
+                    if state['missing'] else "",
+                ", last error: {}".format(state['last_error'])
+                    if state['consecutive_failures'] or state['missing'] else ""))
+
+
+def _backoff(failures: int) -> float:
+    """Seconds to wait after failures in a row."""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+
+
+# Files being downloaded by this process, possibly left running by an
+# earlier download_files that went ahead without them
+_in_flight = set()  # type: set
+_in_flight_lock = threading.Lock()
+
+
+def download_file(connections: Connections, url: str, destfile: str,
+        validators: dict, tries: int=DOWNLOAD_TRIES, sink=None,
+        health: Optional[SourceHealth]=None) -> int:
+    """Bring destfile up to date with url, like wget -c.
+
+    Unless destfile was changed locally, the request is conditional on the
+    validators saved for url, so an unchanged file costs the server a 304.
+
+    If sink is given, sink.data(offset, chunk) is called for every chunk
+    appended to destfile, once it has been written there, and
+    sink.replaced() if destfile was replaced by a whole new copy.
+    sink.done() is called when the download is over, however it ended.
+
+    Connection errors, timeouts and 5xx responses are retried, resuming
+    from whatever was written so far. The outcome is recorded in health,
+    for destfile's source (the name of its directory), which may also
+    lower tries.
+
+    Returns:
+        the number of bytes written.
+    """
+    source = os.path.basename(os.path.dirname(destfile))
+    if health is not None:
+        tries = min(tries, health.tries(source))
+    t_i = time.perf_counter()
+    written = 0
+    try:
+        written, latency = _download_file(connections, url, destfile,
+            validators, tries, sink)
+        if health is not None:
+            health.success(source, latency, time.perf_counter() - t_i - latency,
+                written, url)
+    except DownloadError as e:
+        logging.warning("Couldn't download {}. Error: {}".format(url, e))
+        if health is not None:
+            health.failure(source, str(e), permanent=e.status in (403, 404),
+                url=url)
+    except (OSError, http.client.HTTPException) as e:
+        logging.warning("Couldn't download {}. Error: {!r}".format(url, e))
+        if health is not None:
+            health.failure(source, repr(e))
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(destfile)
+        if sink is not None:
+            sink.done()
+    return written
+
+
+def _download_file(connections: Connections, url: str, destfile: str,
+        validators: dict, tries: int, sink) -> Tuple[int, float]:
+    """Download with retries, raising the last error.
+
+    Returns (bytes written, latency of the successful request).
+    """
+    for attempt in range(1, tries + 1):
+        try:
+            status, n, latency = _get(connections, url, destfile, validators, sink)
+            logging.debug("Downloaded {} bytes from {} ({})".format(n, url, status))
+            return n, latency
+        except DownloadError as e:
+            if e.status < 500 or attempt == tries:
+                raise
+        except (OSError, http.client.HTTPException):
+            if attempt == tries:
+                raise
+        logging.debug("Retrying {} ({} of {})".format(url, attempt + 1, tries))
+        time.sleep(min(2 ** attempt, 30) / 10)
+    raise AssertionError("unreachable")
+
+
+def download_source_files(urls: Sequence, dest: str,
+        connections: Optional[Connections]=None,
+        validators: Optional[dict]=None) -> dict:
+    """Download logfile/milestone files for a single source.
+
+    Returns:
+        {destfile: bytes written}
+    """
+    logging.debug("Downloading {} files to {}".format(len(urls), dest))
+    return download_files([(url, dest) for url in urls], connections,
+        validators)
+
+
+def download_files(jobs: Iterable[Tuple[str, str]],
+        connections: Optional[Connections]=None,
+        validators: Optional[dict]=None,
+        threads: int=SIMULTANEOUS_DOWNLOADS,
+        sinks: Optional[dict]=None,
+        health: Optional[SourceHealth]=None,
+        deadline: Optional[float]=DOWNLOAD_DEADLINE) -> dict:
+    """Download every (url, destination directory) in jobs, in threads.
+
+    If connections isn't given, a pool is made for this call. validators,
+    see load_validators, are used and updated in place. sinks are
+    {destfile: sink}, see download_file.
+
+    Sources that health says are backing off are skipped, as are files
+    still being downloaded by an earlier call. Downloads that haven't
+    finished after deadline seconds are left running in the background,
+    with their sinks marked done, and this returns without them. health is
+    saved again as each of those finishes.
+
+    Returns:
+        {destfile: bytes written} for the downloads that finished
+    """
+    own = connections is None
+    connections = connections or Connections()
+    validators = {} if validators is None else validators
+    sinks = sinks or {}
+    health = health or SourceHealth()
+    health.start()
+    futures = {}
+    pending = set()  # type: set
+    executor = concurrent.futures.ThreadPoolExecutor(threads)
+    try:
+        for url, dest in jobs:
+            destfile = os.path.join(dest, url_to_filename(url))
+            sink = sinks.get(destfile)
+            with _in_flight_lock:
+                busy = destfile in _in_flight
+                skip = busy or not health.ready(os.path.basename(dest), url)
+                if not skip:
+                    _in_flight.add(destfile)
+            if skip:
+                logging.info("Skipping {}, {}".format(url,
+                    "still downloading" if busy else "backing off"))
+                if sink is not None:
+                    sink.done()
+                continue
+            futures[destfile] = executor.submit(download_file,
+                connections, url, destfile, validators, sink=sink,
+                health=health)
+        done, pending = concurrent.futures.wait(futures.values(), deadline)
+        for destfile, f in futures.items():
+            if f in pending:
+                logging.warning("{} is still downloading after {} seconds, "
+                    "going ahead without it".format(destfile, deadline))
+                f.add_done_callback(lambda f: health.save())
+                if destfile in sinks:
+                    sinks[destfile].done()
+        return {destfile: f.result() for destfile, f in futures.items()
+            if f in done}
+    finally:
+        executor.shutdown(wait=False)
+        if own and not pending:
+            connections.close()
+
+
+def download_sources(sources_yaml_path: str, dest: str, servers: Optional[str]=None,
+        connections: Optional[Connections]=None,
+        sinks: Optional[dict]=None,
+        health: Optional[SourceHealth]=None) -> dict:
     """Download all logfile/milestone files.
 
     Parameters:
         dest: path to download destination directory
         servers: if specified, the servers to download from
+        connections: a Connections to reuse, e.g. between refreshes
+        sinks: {destfile: sink} to follow downloads as they happen, see
+            download_file
+        health: the SourceHealth to use and update, loaded from
+            dest/HEALTH_FILE if not given
+
+    The validators of every URL are kept in dest/VALIDATORS_FILE, so files
+    that haven't changed since the last call aren't downloaded again.
 
     Returns:
-        Nothing
+        {destfile: bytes written}, all 0 if nothing changed upstream
     """
     #logging.debug("Downloading source files to {}".format(dest))
     if not os.path.exists(dest):
@@ -116,15 +634,21 @@ def download_sources(sources_yaml_path: str, dest: str, servers: Optional[str]=N
             else:
                 logging.info("Invalid server '%s' specified, skipping." % server)
         all_sources = temp
-    # Not yet in typeshet
-    p = multiprocessing.Pool(SIMULTANEOUS_DOWNLOADS)  # type: ignore
     jobs = []
     for src, urls in all_sources.items():
         destdir = os.path.join(dest, src)
         if not os.path.exists(destdir):
-            os.mkdir(destdir)
-        jobs.append(p.apply_async(download_source_files, (list(urls.values()), destdir)))
-    for job in jobs:
-        job.get()
-    p.close()
-    p.join()
+            os.makedirs(destdir, exist_ok=True)
+        jobs.extend((url, destdir) for url in urls.values())
+    validators_file = os.path.join(dest, VALIDATORS_FILE)
+    validators = load_validators(validators_file)
+    health_file = os.path.join(dest, HEALTH_FILE)
+    if health is None:
+        health = SourceHealth.load(health_file)
+    try:
+        return download_files(jobs, connections, validators, sinks=sinks,
+            health=health)
+    finally:
+        save_validators(validators_file, validators)
+        health.save()
+        health.log_summary()
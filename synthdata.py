@@ -0,0 +1,208 @@
+"""Generate synthetic bcrawl milestones and logfiles for testing and benchmarks.
+
+Usage:
+    python synthdata.py OUTDIR [players] [games] [seed]
+
+Writes a sources directory laid out like the one refresh reads, with a
+milestones file and a logfile for every server in sources_csdc.yml. About
+half the games are one of the csdc.WEEKS combos started inside that week,
+the rest are random combos around the tournament. Games go down the
+dungeon gaining XL, worship and champion gods, pick up runes and the orb,
+and most of them end in the logfile.
+"""
+
+import datetime
+import os
+import random
+import sys
+from typing import Optional
+
+import constants as const
+import csdc
+import modelutils
+import sources
+
+SOURCES_FILE = 'sources_csdc.yml'
+# Chance that a game is one of the tournament combos
+COMBO_SHARE = 0.5
+# Chance that a game has ended by the time the files are written
+END_SHARE = 0.8
+
+# Branches a game goes through, in order, with the rune at their end
+_ROUTE = (
+    ("Lair", 5, None),
+    ("Orc", 2, None),
+    ("Vaults", 3, "silver"),
+    ("Slime", 5, "slimy"),
+    ("Dis", 2, "iron"),
+    ("Tar", 2, "bone"),
+    ("Geh", 2, "obsidian"),
+    ("Coc", 2, "icy"),
+    ("Pan", 1, "demonic"),
+)
+_GODS = ("Trog", "Makhleb", "Okawaru", "Qazlal", "Jiyva", "Lugonu",
+        "Cheibriados", "Vehumet")
+_DEATHS = ("mon", "mon", "mon", "beam", "pois", "quitting", "leaving")
+
+
+def _esc(value) -> str:
+    return str(value).replace(":", "::")
+
+
+def _line(fields: dict) -> str:
+    return ":".join("%s=%s" % (k, _esc(v)) for k, v in fields.items()) + "\n"
+
+
+def _crawl_date(d: datetime.datetime) -> str:
+    return modelutils.datetime_to_crawl_date(d) + "S"
+
+
+class _Game:
+    """Builds the lines of one game."""
+
+    def __init__(self, rng: random.Random, name: str, char: str,
+            start: datetime.datetime) -> None:
+        self.rng = rng
+        self.now = start
+        self.lines = []  # type: list
+        self.fields = {
+            "v": "1.5.0", "vlong": "1.5.0-synthetic", "lv": "0.1",
+            "name": name, "race": char[:2], "cls": char[2:], "char": char,
+            "xl": 1, "sk": "Fighting", "sklev": 1, "title": "Candidate",
+            "place": "D:1", "br": "D", "lvl": 1, "absdepth": 1,
+            "hp": 15, "mhp": 15, "mmhp": 15, "start": _crawl_date(start),
+            "dur": 0, "turn": 0, "potionsused": 0, "scrollsused": 0,
+        }
+        self.runes = 0
+
+    def _advance(self) -> None:
+        seconds = self.rng.randint(60, 2400)
+        self.now += datetime.timedelta(seconds=seconds)
+        f = self.fields
+        f["dur"] += seconds
+        f["turn"] += self.rng.randint(seconds, seconds * 10)
+        f["potionsused"] += self.rng.randint(0, 2)
+        f["scrollsused"] += self.rng.randint(0, 2)
+        if f["xl"] < 27 and self.rng.random() < 0.6:
+            f["xl"] += 1
+            f["sklev"] = min(27, f["sklev"] + 1)
+            self._write("xl", "reached experience level %d." % f["xl"])
+
+    def _write(self, verb: str, msg: str) -> None:
+        line = dict(self.fields, time=_crawl_date(self.now), type=verb,
+            milestone=msg)
+        if self.runes:
+            line["urune"] = self.runes
+        self.lines.append((self.now, _line(line)))
+
+    def milestone(self, verb: str, msg: str, br: Optional[str]=None,
+            lvl: Optional[int]=None) -> None:
+        self._advance()
+        f = self.fields
+        if br is not None:
+            f["br"], f["lvl"] = br, lvl
+            f["place"] = br if br == "Pan" else "%s:%d" % (br, lvl)
+        self._write(verb, msg)
+
+    def end(self, ktyp: str) -> tuple:
+        """Returns (end time, logfile line)."""
+        self._advance()
+        f = dict(self.fields, end=_crawl_date(self.now), ktyp=ktyp,
+            tmsg="escaped with the Orb" if ktyp == "winning" else "killed",
+            sc=self.rng.randint(10, 10000000), urune=self.runes)
+        f["dam"] = f["tdam"] = f["sdam"] = self.rng.randint(1, 100)
+        return self.now, _line(f)
+
+
+def _play(rng: random.Random, name: str, char: str,
+        start: datetime.datetime) -> tuple:
+    """Play out a game.
+
+    Returns ([(time, milestone line)], (end time, logfile line) or None).
+    """
+    g = _Game(rng, name, char, start)
+    g.milestone("begin", "began the game.")
+    god = None
+    if rng.random() < 0.8:
+        god = rng.choice(_GODS)
+        g.fields["god"] = god
+        g.milestone("god.worship", "became a worshipper of %s." % god)
+
+    depth = rng.expovariate(1 / 3.0)
+    won = False
+    for i, (br, levels, rune) in enumerate(_ROUTE):
+        if i >= depth:
+            break
+        g.milestone("br.enter", "entered %s." % br, br, 1)
+        if god and rng.random() < 0.3:
+            g.milestone("god.maxpiety", "became a champion of %s." % god)
+        if rune:
+            g.runes += 1
+            g.milestone("rune", "found a %s rune of Zot." % rune, br, levels)
+    else:
+        if rng.random() < 0.7:
+            g.milestone("br.enter", "entered Zot.", "Zot", 1)
+            g.milestone("orb", "found the Orb of Zot!", "Zot", 5)
+            won = rng.random() < 0.9
+
+    if won:
+        return g.lines, g.end("winning")
+    if rng.random() < END_SHARE:
+        return g.lines, g.end(rng.choice(_DEATHS))
+    return g.lines, None
+
+
+def generate(out: str, players: int=100, games: int=1000, seed: int=1,
+        sources_file: str=SOURCES_FILE) -> int:
+    """Write synthetic source files under out.
+
+    Returns the number of lines written.
+    """
+    rng = random.Random(seed)
+    source_data = sources.source_data(sources_file)
+    servers = sorted(source_data)
+    species = sorted(sp.short for sp in const.SPECIES)
+    backgrounds = sorted(bg.short for bg in const.BACKGROUNDS)
+    first = min(wk["start"] for wk in csdc.WEEKS) - datetime.timedelta(days=3)
+    last = max(wk["end"] for wk in csdc.WEEKS) + datetime.timedelta(days=1)
+    names = ["Player%d" % i for i in range(players)]
+
+    milestones = {srv: [] for srv in servers}  # type: dict
+    logfiles = {srv: [] for srv in servers}  # type: dict
+    for _ in range(games):
+        name = rng.choice(names)
+        if rng.random() < 0.1:
+            name = name.upper()
+        if rng.random() < COMBO_SHARE:
+            wk = rng.choice(csdc.WEEKS)
+            char = wk["species"] + wk["background"]
+            lo, hi = wk["start"], wk["end"]
+        else:
+            char = rng.choice(species) + rng.choice(backgrounds)
+            lo, hi = first, last
+        start = lo + datetime.timedelta(
+            seconds=rng.randint(0, int((hi - lo).total_seconds())))
+        srv = rng.choice(servers)
+        lines, end = _play(rng, name, char, start)
+        milestones[srv].extend(lines)
+        if end is not None:
+            logfiles[srv].append(end)
+
+    written = 0
+    for srv in servers:
+        os.makedirs(os.path.join(out, srv), exist_ok=True)
+        for kind, rows in (("milestones", milestones[srv]), ("logfile", logfiles[srv])):
+            path = os.path.join(out, srv,
+                sources.url_to_filename(source_data[srv][kind]))
+            rows.sort(key=lambda r: r[0])
+            with open(path, 'w') as f:
+                f.writelines(line for _, line in rows)
+            written += len(rows)
+    return written
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    args = [int(x) for x in sys.argv[2:5]]
+    print(generate(sys.argv[1], *args), "lines written")
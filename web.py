@@ -1,6 +1,7 @@
 import datetime
 from orm import get_session
 from modelutils import morgue_url
+from model import get_ktyp
 import csdc
 
 TIMEFMT = "%H:%M %Z"
@@ -86,6 +87,7 @@ def scoretable(wk, div):
 	</tr>""")
 
 	with get_session() as s:
+		winning_id = get_ktyp(s, "winning").id
 		for g in wk.scorecard().with_session(s).all():
 			if g.Game == None:
 				sp += """<tr class="{}"><td class="name">{}</td>
@@ -106,7 +108,7 @@ def scoretable(wk, div):
 				rune_total += int(_ifnone(getattr(g, bonus_runes[i]), "0"))
 			
 			sp += ('<tr class="{}">'.format(
-				"won" if g.Game.won and g.Game.end <= wk.end else
+				"won" if g.Game.ktyp_id == winning_id and g.Game.end <= wk.end else
 				"alive" if g.Game.alive else
 				"dead"))
 			sp += ('<td class="name"><a href="{}">{}</a></td>'.format(